@@ -0,0 +1,131 @@
+"""
+The tip images. Every image has a strong ETag made from its content and is also served under a name with that hash in
+it, like afvalpunt.3f2a9c0d1e4b5a6c.jpg. The content of a hashed name never changes, so browsers can keep it.
+"""
+import hashlib
+import mimetypes
+import os
+from typing import NamedTuple
+
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+from tips.config import get_photo_path, get_image_sendfile, get_image_accel_prefix
+
+# the path of the images in the urls of the tips
+IMAGE_URL_PATH = 'tips/static/tip_images'
+
+# a plain name can get other content, so it is checked with the ETag every time
+CACHE_CONTROL = 'public, no-cache'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# none serves the file through the WSGI server (which can use sendfile), x-sendfile and x-accel-redirect leave it to
+# the web server in front of it
+IMAGE_SENDFILE = get_image_sendfile()
+IMAGE_ACCEL_PREFIX = get_image_accel_prefix()
+
+
+class Image(NamedTuple):
+    name: str
+    path: str
+    etag: str
+    hashed_name: str
+    mimetype: str
+    size: int
+
+
+def load_image(directory, name):
+    path = os.path.join(directory, name)
+    with open(path, 'rb') as fp:
+        content = fp.read()
+    digest = hashlib.blake2b(content, digest_size=8).hexdigest()
+    stem, extension = os.path.splitext(name)
+    return Image(
+        name=name,
+        path=path,
+        etag=digest,
+        hashed_name=f"{stem}.{digest}{extension}",
+        mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream',
+        size=len(content),
+    )
+
+
+def scan_images(directory):
+    """ Returns the images in the directory by their plain and their hashed name. """
+    images = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith('.') and os.path.isfile(os.path.join(directory, name)):
+            image = load_image(directory, name)
+            images[image.name] = images[image.hashed_name] = image
+    return images
+
+
+_directory = get_photo_path()
+_images = scan_images(_directory)
+
+
+def find_image(name):
+    """
+    Returns the image with this plain or hashed name, or None. Images added after the start are only found by their
+    plain name and are read again every time, they can still change.
+    """
+    image = _images.get(name)
+    if image is None and os.path.basename(name) == name and not name.startswith('.') \
+            and os.path.isfile(os.path.join(_directory, name)):
+        image = load_image(_directory, name)
+    return image
+
+
+def is_immutable(image, name):
+    """ Whether the content of this name never changes, only for the hashed names of the images found at the start. """
+    return name == image.hashed_name and _images.get(name) is image
+
+
+def hashed_url(url):
+    """ Returns the url of a tip image with the hashed name, or the url itself when it is not a known image. """
+    if not url:
+        return url
+    path, _, name = url.rpartition('/')
+    image = _images.get(name)
+    if image is None or not path.endswith(IMAGE_URL_PATH):
+        return url
+    return f"{path}/{image.hashed_name}"
+
+
+def image_headers(image, name):
+    """ The headers of every response with this image, the hashed name is cached for a year. """
+    return [
+        ('Content-Type', image.mimetype),
+        ('ETag', quote_etag(image.etag)),
+        ('Cache-Control', IMMUTABLE_CACHE_CONTROL if is_immutable(image, name) else CACHE_CONTROL),
+        ('Content-Disposition', f'attachment; filename={image.name}'),
+    ]
+
+
+def is_current(image, if_none_match):
+    """ Whether the client has the current version of the image, going by its If-None-Match header. """
+    return image.etag in parse_etags(if_none_match)
+
+
+def handoff_headers(image):
+    """ The headers which leave sending the file to the web server, None when the application sends it. """
+    if IMAGE_SENDFILE == 'x-sendfile':
+        return [('X-Sendfile', image.path)]
+    if IMAGE_SENDFILE == 'x-accel-redirect':
+        return [('X-Accel-Redirect', IMAGE_ACCEL_PREFIX + image.name)]
+    return None
+
+
+def image_response(image, name, request):
+    """ The response for a request of an image by this name, 304 when the client has the current version. """
+    headers = image_headers(image, name)
+    if is_current(image, request.headers.get('If-None-Match')):
+        return Response(status=304, headers=headers)
+
+    handoff = handoff_headers(image)
+    if handoff is not None:
+        return Response(headers=headers + handoff)
+    # the WSGI server can send the file with sendfile
+    body = wrap_file(request.environ, open(image.path, 'rb'))
+    return Response(body, headers=headers + [('Content-Length', str(image.size))], direct_passthrough=True)
@@ -0,0 +1,81 @@
+"""
+Decoding of the request bodies and encoding of the responses. Uses orjson when it is installed and the json module of
+the standard library otherwise, TIPS_JSON_BACKEND selects one explicitly.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from tips.config import get_json_backend, get_max_body_bytes, get_max_batch_body_bytes, get_max_json_depth, \
+    get_max_array_length
+
+JSON_BACKENDS = ('auto', 'orjson', 'json')
+JSON_BACKEND = get_json_backend()
+if JSON_BACKEND not in JSON_BACKENDS:
+    raise ValueError(f"Unknown JSON backend {JSON_BACKEND!r}, use one of {', '.join(JSON_BACKENDS)}")
+if JSON_BACKEND == 'orjson' and orjson is None:
+    raise ImportError("TIPS_JSON_BACKEND is orjson but orjson is not installed")
+
+MAX_BODY_BYTES = get_max_body_bytes()
+MAX_BATCH_BODY_BYTES = get_max_batch_body_bytes()
+MAX_JSON_DEPTH = get_max_json_depth()
+MAX_ARRAY_LENGTH = get_max_array_length()
+
+
+def json_loads(data):
+    """ Decodes JSON from bytes or a str with the standard library. """
+    return json.loads(data)
+
+
+def json_dumps(value):
+    """ Encodes a value to compact JSON bytes with the standard library. """
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+class LimitExceeded(ValueError):
+    pass
+
+
+def check_limits(value, max_depth, max_array_length):
+    """ Raises LimitExceeded when decoded JSON nests objects and arrays deeper than max_depth or has a longer array. """
+    stack = [(value, 1)]
+    while stack:
+        value, depth = stack.pop()
+        if type(value) is dict:
+            children = value.values()
+        elif type(value) is list:
+            if len(value) > max_array_length:
+                raise LimitExceeded(f"An array has more than {max_array_length} elements")
+            children = value
+        else:
+            continue
+        if depth > max_depth:
+            raise LimitExceeded(f"Nested deeper than {max_depth}")
+        stack.extend((child, depth + 1) for child in children)
+
+
+if JSON_BACKEND != 'json' and orjson is not None:
+    # both raise a ValueError for invalid JSON and encode tuples and dict subclasses like the standard library
+    loads = orjson.loads
+    dumps = orjson.dumps
+else:
+    loads = json_loads
+    dumps = json_dumps
+
+
+def decode_body(data, max_bytes):
+    """
+    Decodes a request body. Raises LimitExceeded when it is larger than `max_bytes` or its JSON nests deeper or has
+    longer arrays than configured, and ValueError when it is not valid JSON.
+    """
+    if len(data) > max_bytes:
+        raise LimitExceeded(f"The body is larger than {max_bytes} bytes")
+    try:
+        value = loads(data)
+    except RecursionError as e:
+        raise ValueError("The body nests too deep") from e
+    check_limits(value, MAX_JSON_DEPTH, MAX_ARRAY_LENGTH)
+    return value
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from tips.generator import clock
+
+# rough size of the bookkeeping of one entry (the OrderedDict node and the expiry time)
+_ENTRY_OVERHEAD = 200
+
+
+def _extract(data, path, fields):
+    """ The value at path, with every element projected to `fields` when it is a list. Absent keys are marked. """
+    value = data
+    for key in path:
+        if type(value) is not dict:
+            # objectpath maps a path over a list, so everything from here matters
+            return [True, value]
+        if key not in value:
+            return [False]
+        value = value[key]
+
+    if fields is not None and type(value) is list:
+        value = [_project(element, fields) for element in value]
+    return [True, value]
+
+
+def _project(element, fields):
+    if type(element) is not dict:
+        return element
+    return [_extract(element, field, None) for field in fields]
+
+
+def fingerprint(user_data, paths, sources):
+    """
+    Returns a key for the outcome of the rules for this user. It is made from only the parts of the user data the
+    rules depend on: the `paths` (see rule_engine.read_paths), which of the required `sources` are present, optin
+    and the date, because the rules compare with now().
+    """
+    if not user_data['optin']:
+        parts = [False, clock.today().isoformat()]
+    else:
+        data = user_data['data']
+        parts = [
+            True,
+            clock.today().isoformat(),
+            [source for source in sources if source in data],
+            [_extract(data, path, fields) for (path, fields) in paths],
+        ]
+    encoded = json.dumps(parts, separators=(',', ':'), sort_keys=True, default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=16).digest()
+
+
+class ResultCache:
+    """
+    LRU cache with a time to live and a memory budget in bytes. The cached values are tuples of records which are
+    shared with the snapshot, so only the tuples count towards the budget.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, expires, size)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """ Returns the cached value or None. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, size = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                self.bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = sys.getsizeof(key) + sys.getsizeof(value) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (value, time.monotonic() + self.ttl, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
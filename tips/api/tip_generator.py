@@ -1,64 +1,275 @@
+import heapq
 import json
+import logging
 import os
-
-from objectpath import Tree
-
-from tips.config import PROJECT_PATH
-from tips.generator.rule_engine import apply_rules
+import threading
+import time
+from typing import NamedTuple
+
+from tips.api.images import hashed_url
+from tips.api.json_backend import dumps
+from tips.api.result_cache import ResultCache, fingerprint
+from tips.api.tip_record import FRONT_END_TIP_KEYS, FrozenDict, Tip, validate_tip
+from tips.config import PROJECT_PATH, get_reload_interval, get_result_cache_bytes, get_result_cache_ttl
+from tips.generator import clock, metrics
+from tips.generator.rule_engine import apply_rules, apply_rules_batch, compile_rules, order_rules, required_sources, \
+    rule_paths, prune, EvaluationContext, UserData
 
 TIPS_POOL_FILE = os.path.join(PROJECT_PATH, 'api', 'tips_pool.json')
 TIP_ENRICHMENT_FILE = os.path.join(PROJECT_PATH, 'api', 'tip_enrichments.json')
 COMPOUND_RULES_FILE = os.path.join(PROJECT_PATH, 'api', 'compound_rules.json')
+PERSOONLIJK_INKOMENS_TIPS_FILE = os.path.join(PROJECT_PATH, 'api', 'persoonlijk_inkomens_tips.json')
+CONTENT_FILES = [TIPS_POOL_FILE, TIP_ENRICHMENT_FILE, COMPOUND_RULES_FILE, PERSOONLIJK_INKOMENS_TIPS_FILE]
+
+# names of the pools in a snapshot
+TIPS_POOL = 'tips'
+INCOME_TIPS_POOL = 'income'
 
-FRONT_END_TIP_KEYS = ['datePublished', 'description', 'id', 'link', 'title', 'priority', 'imgUrl', 'isPersonalized', 'reason']
+# seconds between checks whether the content files changed, 0 disables reloading
+RELOAD_INTERVAL = get_reload_interval()
 
+# memory budget of the result cache of a snapshot, 0 disables the cache
+RESULT_CACHE_BYTES = get_result_cache_bytes()
+RESULT_CACHE_TTL = get_result_cache_ttl()
 
-tips_pool = []
-tip_enrichments = []
-compound_rules = []
+logger = logging.getLogger(__name__)
 
 
-def refresh_tips_pool():
-    global tips_pool
-    with open(TIPS_POOL_FILE) as fp:
-        tips_pool = json.load(fp)
+class Snapshot(NamedTuple):
+    """
+    Everything loaded from the content files, prepared for use. A snapshot is never changed once it is built,
+    reloading builds a new snapshot and swaps it in. A request uses the same snapshot from start to finish.
+    """
+    tips_pool: list
+    income_tips_pool: list
+    indexes: dict  # SourceIndex per pool name
+    tip_enrichments: dict  # enrichment per tip id
+    compound_rules: dict
+    mtimes: tuple  # modification times of CONTENT_FILES when the snapshot was built
+    result_cache: ResultCache  # tips matched by the rules per user data fingerprint, None when disabled
 
 
-def refresh_tip_enrichments():
-    global tip_enrichments
-    with open(TIP_ENRICHMENT_FILE) as fp:
-        tip_enrichments = json.load(fp)
+_reload_lock = threading.Lock()
+_next_check = 0
+_failed_mtimes = None
 
 
-def refresh_compound_rules():
-    global compound_rules
-    with open(COMPOUND_RULES_FILE) as fp:
+def load_compound_rules(path):
+    """ Load the compound rules, they are compiled and ordered cheapest first just like the rules of the tips. """
+    with open(path) as fp:
         compound_rules = json.load(fp)
 
+    for compound_rule in compound_rules.values():
+        compile_rules(compound_rule['rules'], compound_rules)
+    for compound_rule in compound_rules.values():
+        compound_rule['rules'] = order_rules(compound_rule['rules'], compound_rules)
+    return compound_rules
+
+
+def load_tips(path, compound_rules):
+    """ Load a tips pool and prepare it for use: resolve the reasons, compile and order the rules. """
+    with open(path) as fp:
+        tips = json.load(fp)
+
+    for tip in tips:
+        tip['reason'] = get_reasoning(tip, compound_rules)
+    compile_pool_rules(tips, compound_rules)
+    return tips
+
+
+def load_tip_enrichments(path):
+    with open(path) as fp:
+        return index_enrichments(json.load(fp))
 
-def get_reasoning(tip):
+
+def index_enrichments(tip_enrichments):
+    """ Returns the enrichment for every tip id. Only one enrichment per tip is allowed, the first one wins. """
+    index = {}
+    for enrichment in tip_enrichments:
+        for tip_id in enrichment['for_ids']:
+            index.setdefault(tip_id, enrichment)
+    return index
+
+
+def get_content_mtimes():
+    return tuple(os.stat(path).st_mtime_ns for path in CONTENT_FILES)
+
+
+def build_snapshot():
+    """ Load all content files into a new snapshot, raises when the content is invalid. """
+    # read these first, so changes made while loading cause another reload
+    mtimes = get_content_mtimes()
+
+    compound_rules = load_compound_rules(COMPOUND_RULES_FILE)
+    tip_enrichments = load_tip_enrichments(TIP_ENRICHMENT_FILE)
+    tips_pool = load_tips(TIPS_POOL_FILE, compound_rules)
+    income_tips_pool = load_tips(PERSOONLIJK_INKOMENS_TIPS_FILE, compound_rules)
+
+    return Snapshot(
+        tips_pool=tips_pool,
+        income_tips_pool=income_tips_pool,
+        indexes={
+            TIPS_POOL: SourceIndex(tips_pool, compound_rules, tip_enrichments),
+            INCOME_TIPS_POOL: SourceIndex(income_tips_pool, compound_rules, tip_enrichments),
+        },
+        tip_enrichments=tip_enrichments,
+        compound_rules=compound_rules,
+        mtimes=mtimes,
+        result_cache=ResultCache(RESULT_CACHE_BYTES, RESULT_CACHE_TTL) if RESULT_CACHE_BYTES else None,
+    )
+
+
+def reload_snapshot():
+    """ Build a new snapshot and swap it in. Requests which are running keep using the old one. """
+    global _snapshot
+    snapshot = build_snapshot()
+    _snapshot = snapshot
+    return snapshot
+
+
+def _reload_in_background():
+    global _failed_mtimes
+    try:
+        reload_snapshot()
+    except Exception:
+        # keep serving the current snapshot, until the files change again
+        _failed_mtimes = get_content_mtimes()
+        logger.exception("Reloading the tips content failed")
+    finally:
+        _reload_lock.release()
+
+
+def _check_for_changes(snapshot):
+    """ Starts a reload in the background when the content files changed, without waiting for it. """
+    global _next_check
+    if not _reload_lock.acquire(blocking=False):
+        return  # already checking or reloading
+
+    reloading = False
+    try:
+        _next_check = time.monotonic() + RELOAD_INTERVAL
+        mtimes = get_content_mtimes()
+        if mtimes != snapshot.mtimes and mtimes != _failed_mtimes:
+            threading.Thread(target=_reload_in_background, daemon=True).start()
+            reloading = True
+    except OSError:
+        logger.exception("Checking the tips content for changes failed")
+    finally:
+        if not reloading:
+            _reload_lock.release()
+
+
+def get_snapshot():
+    """ Returns the current snapshot. Checks at most once every RELOAD_INTERVAL seconds if the content changed. """
+    snapshot = _snapshot
+    if RELOAD_INTERVAL and time.monotonic() >= _next_check:
+        _check_for_changes(snapshot)
+    return snapshot
+
+
+def get_reasoning(tip, compound_rules, _seen=()):
+    """ The reasons of a tip and the compound rules it refers to. A compound rule which refers to itself is followed once. """
     reasons = []
     reason = tip.get('reason')
     if reason:
         reasons.append(reason)
     rules = tip.get('rules', [])
     for rule in rules:
-        if rule['type'] == 'ref':
-            reasons.extend(get_reasoning(compound_rules[rule['ref_id']]))
+        if rule['type'] == 'ref' and rule['ref_id'] not in _seen:
+            ref_id = rule['ref_id']
+            reasons.extend(get_reasoning(compound_rules[ref_id], compound_rules, _seen + (ref_id,)))
 
     return reasons
 
 
-refresh_tips_pool()
-refresh_tip_enrichments()
-refresh_compound_rules()
+def compile_pool_rules(tips, compound_rules):
+    """
+    Compile all rules used by these tips, so broken rules are reported here instead of per request.
+    The rules are ordered cheapest first, so the expensive ones are skipped when a cheap one already fails.
+    """
+    for tip in tips:
+        compile_rules(tip.get('rules', []), compound_rules)
+
+    for tip in tips:
+        if 'rules' in tip:
+            tip['rules'] = order_rules(tip['rules'], compound_rules)
+
+
+class EncodedResponse(FrozenDict):
+    """ A response with its items and total, encoded once so it can be sent as is to every user it is for. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.encoded = encode_response(dict(self))
 
-for tip in tips_pool:
-    reasons = get_reasoning(tip)
-    tip['reason'] = reasons
 
+class PoolEntry(NamedTuple):
+    tip: dict
+    required: frozenset  # sources the rules of the tip need
+    record: Tip  # what is sent to the frontend when the tip matches, with the enrichment applied
 
-def tip_filter(tip, userdata_tree):
+
+class SourceIndex:
+    """
+    Maps every active tip to the user data sources (the keys of user_data['data']) its rules need, so tips which
+    can not match are rejected before any rule runs. The entries are sorted by priority, so the matches are as well.
+    """
+
+    def __init__(self, tips, compound_rules, tip_enrichments):
+        self.tips = tips
+        self.compound_rules = compound_rules
+        self.entries = [
+            PoolEntry(
+                tip,
+                required_sources(tip.get('rules', []), compound_rules),
+                pool_record(tip, tip_enrichments)
+            )
+            for tip in tips if tip['active']
+        ]
+        self.entries.sort(key=lambda entry: _priority(entry.record), reverse=True)
+        # the only tips which can pass when there is no user data at all, like for users who did not opt in
+        self.without_sources = [entry for entry in self.entries if not entry.required]
+
+        # the parts of the user data the outcome of the rules depends on, for the result cache key
+        self.sources = sorted(set().union(*(entry.required for entry in self.entries)))
+        paths = {}
+        for entry in self.entries:
+            rule_paths(entry.tip.get('rules', []), compound_rules, paths)
+        self.paths = sorted(
+            ((path, None if fields is None else sorted(fields)) for (path, fields) in paths.items()),
+            key=lambda item: item[0]
+        )
+
+        self._optout = None
+        self.optout_response()
+
+    def optout_matches(self):
+        """
+        Returns the records of the tips which match for users who did not opt in. Their rules only ever see empty
+        user data, so they run once a day (the rules can compare with now()).
+        """
+        return self.optout_response()['items']
+
+    def optout_response(self):
+        """ The response for users who did not opt in and have no tips in their user data, encoded once a day. """
+        today = clock.today()
+        optout = self._optout
+        if optout is None or optout[0] != today:
+            empty = UserData({})
+            context = EvaluationContext()
+            records = tuple(
+                entry.record for entry in self.without_sources
+                if tip_filter(entry.tip, empty, self.compound_rules, context)
+            )
+            optout = self._optout = (today, EncodedResponse(items=records, total=len(records)))
+        return optout[1]
+
+    def candidates(self, sources):
+        """ Returns the entries of the tips whose required sources are all in `sources`. """
+        return [entry for entry in self.entries if entry.required.issubset(sources)]
+
+
+def tip_filter(tip, userdata_tree, compound_rules, context=None):
     """
     If tip has a field "rules", the result must be true for it to be included.
     If tip does not have "rules, it is included.
@@ -68,22 +279,37 @@ def tip_filter(tip, userdata_tree):
     if 'rules' not in tip:
         return tip
 
-    passed = apply_rules(userdata_tree, tip["rules"], compound_rules)
+    if context is not None and context.timed:
+        start = metrics.clock()
+        passed = apply_rules(userdata_tree, tip["rules"], compound_rules, context)
+        metrics.observe(metrics.TIP, tip.get('id'), metrics.clock() - start, passed)
+        return passed
+
+    passed = apply_rules(userdata_tree, tip["rules"], compound_rules, context)
     return passed
 
 
+def pool_record(tip, tip_enrichments):
+    """ Returns the Tip which is sent to the frontend when this pool tip matches, raises InvalidTip when it is invalid. """
+    fields = with_hashed_image(enrich_tip(clean_tip(tip), tip_enrichments))
+    validate_tip(fields)
+    return Tip(fields)
+
+
 def clean_tip(tip):
     """ Only select the relevant frontend fields and default isPersonalized to False. """
-    if not tip.get('isPersonalized', False):
-        tip['isPersonalized'] = False
     # Only add fields which are allowed to go to the frontend
-    return {k: v for (k, v) in tip.items() if k in FRONT_END_TIP_KEYS}
+    cleaned = {k: v for (k, v) in tip.items() if k in FRONT_END_TIP_KEYS}
+    if not cleaned.get('isPersonalized', False):
+        cleaned['isPersonalized'] = False
+    return cleaned
 
 
 def fix_id(tip, source):
-    """ Some of our data sources do not follow our id guidelines, fix the tip here inplace. """
+    """ Some of our data sources do not follow our id guidelines, returns the fixed id. """
     if source == "belasting":
-        tip['id'] = f"belasting-{tip['id']}"
+        return f"belasting-{tip['id']}"
+    return tip['id']
 
 
 def format_tip(tip):
@@ -109,65 +335,210 @@ def format_tip(tip):
     }
 
 
-def get_tips_from_user_data(user_data):
-    """ If the data from the client has source tips, return them as a list """
-    source_tips = []
+def _user_data_tips(user_data):
     for source, value in user_data['data'].items():
-        if type(value) == dict and 'tips' in value:
+        if type(value) is dict and 'tips' in value:
             for tip in value['tips']:
-                fix_id(tip, source)
-            source_tips = source_tips + value['tips']
+                # make sure they follow the format, this also leaves out any conditionals because of security
+                source_tip = format_tip(tip)
+                source_tip['id'] = fix_id(tip, source)
+                yield source_tip
+
+
+def get_tips_from_user_data(user_data):
+    """ If the data from the client has source tips, return them as a list """
+    return list(_user_data_tips(user_data))
 
-    # make sure they follow the format
-    source_tips = [format_tip(tip) for tip in source_tips]
 
-    # remove any conditionals because of security
-    for tip in source_tips:
-        if 'conditional' in tip:
-            del tip['conditional']
+def source_tips(user_data, tip_enrichments):
+    """ Returns the source tips as they are sent to the frontend, formatted, cleaned and enriched in one pass. """
+    return [enrich_tip(clean_tip(tip), tip_enrichments) for tip in _user_data_tips(user_data)]
 
-    return source_tips
+
+def with_hashed_image(tip):
+    """ Returns the tip with the url of the image which never changes, so browsers can keep it. """
+    if tip.get('imgUrl') is None:
+        return tip
+    return {**tip, 'imgUrl': hashed_url(tip['imgUrl'])}
 
 
 def apply_enrichment(tip, enrichment):
-    for key, value in enrichment['fields'].items():
-        tip[key] = value
+    """ Returns a copy of the tip with the enrichment applied. """
+    return {**tip, **enrichment['fields']}
 
 
-def enrich_tip(tip):
-    for enrichment in tip_enrichments:
-        if tip['id'] in enrichment['for_ids']:
-            apply_enrichment(tip, enrichment)
-            break  # only one enrichment per tip allowed
+def enrich_tip(tip, tip_enrichments):
+    """ Returns the enriched tip, or the tip itself when there is no enrichment for it. """
+    enrichment = tip_enrichments.get(tip['id'])
+    if enrichment is None:
+        return tip
+    return apply_enrichment(tip, enrichment)
 
 
-def tips_generator(user_data, tips=None):
-    """ Generate tips. """
-    if tips is None:
-        tips = tips_pool
+def _priority(tip):
+    return tip['priority']
 
-    # add source tips
-    source_tips = get_tips_from_user_data(user_data)
-    if source_tips:
-        tips = tips + source_tips
 
-    if user_data['optin']:
-        user_data_prepared = Tree(user_data['data'])
-    else:
-        user_data_prepared = Tree({})
+def sort_tips(tips):
+    """ Sorts the tips from the highest priority to the lowest, in place. """
+    tips.sort(key=_priority, reverse=True)
+    return tips
+
+
+def merge_tips(sorted_tips, tips):
+    """
+    Returns the sorted tips with `tips` added in order of priority, like sorting them all together would. Tips with the
+    same priority keep their order and those of `sorted_tips` come first.
+    """
+    return list(heapq.merge(sorted_tips, sort_tips(tips), key=_priority, reverse=True))
 
-    tips = [tip for tip in tips if tip_filter(tip, user_data_prepared)]
-    tips = [clean_tip(tip) for tip in tips]
-    for tip in tips:
-        enrich_tip(tip)
 
-    tips.sort(key=lambda t: t['priority'], reverse=True)
+def match_tips(user_data, index, compound_rules):
+    """ Returns the records of the tips in the index which pass their rules for this user. """
+    if not user_data['optin']:
+        return index.optout_matches()
+
+    entries = index.candidates(user_data['data'].keys())
+    # the rules only see the parts of the user data they read
+    user_data_prepared = UserData(prune(user_data['data'], index.paths))
+    # shared by all tips, so compound rules are only evaluated once for this user
+    context = EvaluationContext()
+    records = tuple(entry.record for entry in entries if tip_filter(entry.tip, user_data_prepared, compound_rules, context))
+    metrics.count_rules(context.evaluated, context.skipped)
+    return records
+
+
+def match_tips_batch(user_datas, index, compound_rules):
+    """
+    match_tips for many users. Every tip is evaluated for all users it is a candidate for together, rule by rule,
+    so each expression runs across the users back to back. Returns the tuple of records of every user.
+    """
+    optout_records = index.optout_matches()
+    matched = [[] if user_data['optin'] else optout_records for user_data in user_datas]
+    optin = [user for user in range(len(user_datas)) if user_datas[user]['optin']]
+    trees = {user: UserData(prune(user_datas[user]['data'], index.paths)) for user in optin}
+    contexts = {user: EvaluationContext() for user in optin}
+
+    for entry in index.entries:
+        users = [user for user in optin if entry.required.issubset(user_datas[user]['data'].keys())]
+        if users and 'rules' in entry.tip:
+            passed = apply_rules_batch(
+                [trees[user] for user in users],
+                entry.tip['rules'],
+                compound_rules,
+                [contexts[user] for user in users]
+            )
+            users = [users[i] for i in passed]
+        for user in users:
+            matched[user].append(entry.record)
+
+    metrics.count_rules(sum(context.evaluated for context in contexts.values()),
+                        sum(context.skipped for context in contexts.values()))
+    return [tuple(records) for records in matched]
+
+
+def _tips_response(matched, user_data, tip_enrichments):
+    """
+    Returns the response for the matched pool records of this user, which are sorted by priority, with the tips from
+    the user data merged in.
+    """
+    # source tips are not cached, the pool tips are enriched already
+    tips = source_tips(user_data, tip_enrichments)
 
     # if optin is on, only show personalised tips
     if user_data['optin']:
+        matched = [t for t in matched if t['isPersonalized']]
         tips = [t for t in tips if t['isPersonalized']]
 
+    # the records are shared with other requests, they are never changed
+    tips = merge_tips(matched, tips) if tips else list(matched)
+    return {
+        "items": tips,
+        "total": len(tips),
+    }
+
+
+def encode_response(response):
+    """ Encodes a response of tips_generator to JSON bytes, the pool records are included as they were encoded. """
+    if type(response) is EncodedResponse:
+        return response.encoded
+    items = b','.join(item.encoded if type(item) is Tip else dumps(item) for item in response['items'])
+    return b'{"items":[%s],"total":%d}' % (items, response['total'])
+
+
+def encode_responses(responses):
+    """ Encodes the responses of tips_generator_batch to a JSON array. """
+    return b'[%s]' % b','.join(encode_response(response) for response in responses)
+
+
+def _optout_response(user_data, index, tip_enrichments):
+    """
+    The response for a user who did not opt in, without running any rules. It is the same for all of them except for
+    the tips in their user data, which are merged into it.
+    """
+    response = index.optout_response()
+    tips = source_tips(user_data, tip_enrichments)
+    if not tips:
+        return response
+
+    tips = merge_tips(response['items'], tips)
     return {
         "items": tips,
         "total": len(tips),
     }
+
+
+def tips_generator(user_data, tips=None, pool=TIPS_POOL):
+    """ Generate tips. Uses the given list of tips, or when that is None the named pool of the current snapshot. """
+    snapshot = get_snapshot()
+    cache = None
+    if tips is None:
+        index = snapshot.indexes[pool]
+        cache = snapshot.result_cache
+    else:
+        index = SourceIndex(tips, snapshot.compound_rules, snapshot.tip_enrichments)
+
+    if not user_data['optin']:
+        return _optout_response(user_data, index, snapshot.tip_enrichments)
+
+    if cache is not None:
+        key = (pool, fingerprint(user_data, index.paths, index.sources))
+        matched = cache.get(key)
+        if matched is None:
+            matched = match_tips(user_data, index, snapshot.compound_rules)
+            cache.put(key, matched)
+    else:
+        matched = match_tips(user_data, index, snapshot.compound_rules)
+
+    return _tips_response(matched, user_data, snapshot.tip_enrichments)
+
+
+def tips_generator_batch(user_datas, pool=TIPS_POOL):
+    """ Generate tips for a list of users from the named pool, returns the result of every user in the same order. """
+    snapshot = get_snapshot()
+    index = snapshot.indexes[pool]
+    cache = snapshot.result_cache
+
+    # the users who did not opt in get the prebuilt result
+    optin = [user for user in range(len(user_datas)) if user_datas[user]['optin']]
+    matched = {}
+    if cache is not None:
+        keys = {user: (pool, fingerprint(user_datas[user], index.paths, index.sources)) for user in optin}
+        matched = {user: cache.get(keys[user]) for user in optin}
+
+    missing = [user for user in optin if matched.get(user) is None]
+    if missing:
+        results = match_tips_batch([user_datas[user] for user in missing], index, snapshot.compound_rules)
+        for user, result in zip(missing, results):
+            matched[user] = result
+            if cache is not None:
+                cache.put(keys[user], result)
+
+    return [
+        _tips_response(matched[user], user_data, snapshot.tip_enrichments) if user_data['optin']
+        else _optout_response(user_data, index, snapshot.tip_enrichments)
+        for (user, user_data) in enumerate(user_datas)
+    ]
+
+
+_snapshot = build_snapshot()
@@ -0,0 +1,76 @@
+"""
+The records of the pool tips, as they are sent to the frontend. They are shared by all requests, so they can not be
+changed, and they are checked against the tip schema of the openapi specification when the content is loaded.
+"""
+import os
+
+import yaml
+from jsonschema import Draft4Validator
+
+from tips.api.json_backend import dumps
+from tips.config import PROJECT_PATH
+
+OPENAPI_FILE = os.path.join(PROJECT_PATH, 'openapi', 'tips.yaml')
+
+FRONT_END_TIP_KEYS = ['datePublished', 'description', 'id', 'link', 'title', 'priority', 'imgUrl', 'isPersonalized', 'reason']
+
+
+def _tip_validator():
+    with open(OPENAPI_FILE) as fp:
+        return Draft4Validator(yaml.safe_load(fp)['components']['schemas']['tip'])
+
+
+_validator = _tip_validator()
+
+
+class InvalidTip(ValueError):
+    pass
+
+
+def validate_tip(fields):
+    """ Raises InvalidTip when the fields of a tip (a plain dict) do not follow the tip schema. """
+    for error in _validator.iter_errors(fields):
+        path = '.'.join(str(key) for key in error.path)
+        raise InvalidTip(f"Tip {fields.get('id')!r} is invalid at {path or 'the top'}: {error.message}")
+
+
+class FrozenDict(dict):
+    """ A dict which can not be changed, for the records which are shared by all requests. """
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f"{type(self).__name__} can not be changed")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+def freeze(value):
+    """ Returns a frozen copy of a json value, objects become FrozenDicts and arrays become tuples. """
+    if type(value) is dict:
+        return FrozenDict((k, freeze(v)) for (k, v) in value.items())
+    if type(value) is list:
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class Tip(FrozenDict):
+    """
+    A pool tip as it is sent to the frontend, a frozen dict of the FRONT_END_TIP_KEYS it has, in that order.
+    `encoded` is its JSON, encoded once, and the only attribute it has.
+    """
+    __slots__ = ('encoded',)
+
+    def __init__(self, fields):
+        super().__init__((key, freeze(fields[key])) for key in FRONT_END_TIP_KEYS if key in fields)
+        object.__setattr__(self, 'encoded', dumps(self))
+
+    def __setattr__(self, name, value):
+        raise TypeError(f"{type(self).__name__} can not be changed")
+
+    __delattr__ = __setattr__
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
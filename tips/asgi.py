@@ -0,0 +1,121 @@
+"""
+ASGI entry point, next to the WSGI application in tips.server, for an ASGI server like uvicorn:
+
+    uvicorn tips.asgi:application
+
+A Starlette application around the WSGI application, so the endpoints, their validation and their responses are the
+same. The requests which run the rules are handled in a pool of TIPS_ASGI_WORKERS threads. They wait for a thread
+without holding one, when more than TIPS_ASGI_QUEUE requests are waiting the others get a 503, requests only count once
+their body has been received. The other endpoints, like the health checks and the images, have threads of their own and
+never wait for the rules.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.requests import ClientDisconnect, Request
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+from tips.api import json_backend
+from tips.config import get_asgi_workers, get_asgi_queue
+from tips.server import application as wsgi_application, BATCH_PATH
+
+ASGI_WORKERS = get_asgi_workers()
+ASGI_QUEUE = get_asgi_queue()
+
+# the endpoints which run the rules
+EVALUATION_PATHS = ('/tips/gettips', '/tips/getincometips', BATCH_PATH)
+
+# the WSGI application in the pool which runs the rules, and for the other endpoints
+_rules = WSGIMiddleware(wsgi_application, workers=ASGI_WORKERS)
+_others = WSGIMiddleware(wsgi_application)
+# requests with a body which are evaluating or waiting for a thread, only changed on the event loop
+_pending = 0
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def problem(status, detail):
+    """ An error response like those of connexion. """
+    body = {"detail": detail, "status": status, "title": HTTPStatus(status).phrase, "type": "about:blank"}
+    return JSONResponse(body, status, media_type='application/problem+json')
+
+
+async def _read_body(request, max_bytes):
+    """ Reads the request body, stops with BodyTooLarge as soon as it is larger than `max_bytes`. """
+    if int(request.headers.get('content-length') or 0) > max_bytes:
+        raise BodyTooLarge(f"The body is larger than {max_bytes} bytes")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise BodyTooLarge(f"The body is larger than {max_bytes} bytes")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def _replay(scope, body, receive):
+    """
+    The scope and receive of a request of which the body was already read. The scope has its length, which the WSGI
+    application needs, also when the client sent it in chunks.
+    """
+    headers = [(key, value) for (key, value) in scope['headers'] if key not in (b'content-length', b'transfer-encoding')]
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def replay():
+        return messages.pop() if messages else await receive()
+    return dict(scope, headers=headers + [(b'content-length', str(len(body)).encode())]), replay
+
+
+class Evaluation:
+    """ An endpoint which runs the rules: its request waits for a thread of the pool and then goes to the WSGI application. """
+
+    async def __call__(self, scope, receive, send):
+        global _pending
+        request = Request(scope, receive)
+        max_bytes = json_backend.MAX_BATCH_BODY_BYTES if scope['path'] == BATCH_PATH else json_backend.MAX_BODY_BYTES
+        try:
+            # a request only counts once its body is read, so slow uploads do not fill the queue
+            body = await _read_body(request, max_bytes)
+        except BodyTooLarge as e:
+            await problem(413, str(e))(scope, receive, send)
+            return
+        except ClientDisconnect:
+            return
+        if _pending >= ASGI_WORKERS + ASGI_QUEUE:
+            await problem(503, "Too many requests are waiting")(scope, receive, send)
+            return
+
+        _pending += 1
+        try:
+            await _rules(*_replay(scope, body, receive), send)
+        finally:
+            _pending -= 1
+
+
+@asynccontextmanager
+async def _lifespan(app):
+    yield
+    # waits for the rules which are still running, without blocking the event loop
+    await asyncio.get_running_loop().run_in_executor(None, _rules.executor.shutdown)
+
+
+_routes = [Route(path, Evaluation(), methods=['POST']) for path in EVALUATION_PATHS]
+# everything else, like other methods on the endpoints above, goes to the WSGI application as it is
+_app = Starlette(routes=_routes + [Mount('/', _others)], lifespan=_lifespan)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        # there are no websocket endpoints, closing it before it is accepted refuses the connection
+        await send({'type': 'websocket.close'})
+        return
+    if scope['type'] not in ('http', 'lifespan'):
+        raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+    await _app(scope, receive, send)
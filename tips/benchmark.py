@@ -0,0 +1,184 @@
+"""
+Benchmarks of the tips generation hot path.
+
+Times apply_rules, tips_generator and the two POST endpoints (through the Flask test client) against synthetic user
+data and reports p50/p95/p99 and the memory allocated per call.
+
+    python -m tips.benchmark
+    python -m tips.benchmark --save baseline.json
+    python -m tips.benchmark --compare baseline.json
+"""
+import argparse
+import copy
+import json
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from tips.api.tip_generator import get_snapshot, tips_generator, TIPS_POOL, INCOME_TIPS_POOL
+from tips.generator.rule_engine import apply_rules, UserData
+from tips.tests.fixtures.fixture import get_fixture
+
+# number of focus products, children, wmo voorzieningen and belasting tips per size
+SIZES = {
+    'realistic': {'focus': 8, 'kinderen': 2, 'wmo': 28, 'belasting': 1},
+    'large': {'focus': 500, 'kinderen': 12, 'wmo': 300, 'belasting': 200},
+}
+
+PERCENTILES = [50, 95, 99]
+
+
+def _iso(moment):
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _random_date(rnd, min_years, max_years):
+    # at midnight, like the dates in the BRP, so the same seed gives the same data all day
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    return _iso(today - timedelta(days=rnd.randint(int(min_years * 365), int(max_years * 365))))
+
+
+def generate_user_data(rnd, size, optin=True):
+    """ Returns user data shaped like the fixtures, with the lists grown to `size` and the dates randomized. """
+    counts = SIZES[size]
+    user_data = get_fixture(optin=optin)
+    data = user_data['data']
+
+    brp = data['brp']
+    brp['persoon']['geboortedatum'] = _random_date(rnd, 16, 90)
+    brp['persoon']['mokum'] = rnd.random() < 0.9
+    brp['adres']['begindatumVerblijf'] = _random_date(rnd, 0, 10)
+    kind = brp['kinderen'][0]
+    brp['kinderen'] = [dict(kind, geboortedatum=_random_date(rnd, 0, 25)) for _ in range(rnd.randint(0, counts['kinderen']))]
+
+    focus = data['focus']
+    data['focus'] = []
+    for i in range(counts['focus']):
+        product = copy.deepcopy(focus[i % len(focus)])
+        product['_id'] = f'{i}-0'
+        product['typeBesluit'] = rnd.choice(['Toekenning', 'Afwijzing'])
+        if product['processtappen'].get('beslissing'):
+            product['processtappen']['beslissing']['datum'] = _random_date(rnd, 0, 3)
+        data['focus'].append(product)
+
+    wmo = data['wmo']
+    data['wmo'] = [copy.deepcopy(wmo[i % len(wmo)]) for i in range(counts['wmo'])]
+
+    tip = data['belasting']['tips'][0]
+    data['belasting']['tips'] = [dict(tip, id=i) for i in range(counts['belasting'])]
+
+    return user_data
+
+
+def measure(function, payloads, repeat):
+    """ Run function for every payload `repeat` times, returns the timings in microseconds and allocations in KiB. """
+    timings = []
+    for _ in range(repeat):
+        for payload in payloads:
+            start = time.perf_counter()
+            function(payload)
+            timings.append((time.perf_counter() - start) * 1e6)
+
+    # measured separately, tracing allocations slows everything down. Tracing starts again for every payload, which
+    # resets the peak (tracemalloc.reset_peak needs Python 3.9)
+    allocated = []
+    for payload in payloads:
+        tracemalloc.start()
+        function(payload)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        allocated.append(peak / 1024)
+
+    timings.sort()
+    result = {
+        f'p{p}_us': round(timings[min(len(timings) - 1, len(timings) * p // 100)], 1)
+        for p in PERCENTILES
+    }
+    result['mean_us'] = round(sum(timings) / len(timings), 1)
+    result['peak_alloc_kib'] = round(sum(allocated) / len(allocated), 1)
+    return result
+
+
+def _apply_pool_rules(user_data):
+    snapshot = get_snapshot()
+    tree = UserData(user_data['data'])
+    for tip in snapshot.tips_pool + snapshot.income_tips_pool:
+        if tip['active'] and 'rules' in tip:
+            apply_rules(tree, tip['rules'], snapshot.compound_rules)
+
+
+def get_cases():
+    from tips.server import application
+    client = application.test_client()
+
+    def post(url):
+        def request(user_data):
+            response = client.post(url, json=user_data)
+            assert response.status_code == 200, response.data
+        return request
+
+    return {
+        'apply_rules': _apply_pool_rules,
+        'tips_generator': lambda user_data: tips_generator(user_data, pool=TIPS_POOL),
+        'tips_generator_income': lambda user_data: tips_generator(user_data, pool=INCOME_TIPS_POOL),
+        'POST /tips/gettips': post('/tips/gettips'),
+        'POST /tips/getincometips': post('/tips/getincometips'),
+    }
+
+
+def run(sizes, users, repeat, seed):
+    rnd = random.Random(seed)
+    cases = get_cases()
+    results = {}
+    for size in sizes:
+        payloads = [generate_user_data(rnd, size) for _ in range(users)]
+        for name, function in cases.items():
+            results[f'{name} [{size}]'] = measure(function, payloads, repeat)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Prints the change against the baseline, returns the names of the cases where p50 regressed beyond threshold. """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['p50_us'] / baseline[name]['p50_us']
+        print(f"{name:45} p50 {baseline[name]['p50_us']:>10} -> {result['p50_us']:>10} us ({ratio:.2f}x)")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', choices=SIZES, action='append', help="payload size, can be repeated (default: all)")
+    parser.add_argument('--users', type=int, default=20, help="number of synthetic users per size")
+    parser.add_argument('--repeat', type=int, default=10, help="times every user is run")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', metavar='FILE', help="save the results as baseline")
+    parser.add_argument('--compare', metavar='FILE', help="compare with a saved baseline")
+    parser.add_argument('--threshold', type=float, default=1.2, help="p50 ratio that counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.size or list(SIZES), args.users, args.repeat, args.seed)
+    print(json.dumps(results, indent=2))
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Regressions:", ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
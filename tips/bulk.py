@@ -0,0 +1,97 @@
+"""
+Generates the tips for many users offline.
+
+Reads user data as newline delimited JSON (one body of /tips/gettips per line) from a file or stdin and writes the
+result of every user as a line of NDJSON, in the same order. The number of users and how many of them matched every
+tip are written to stderr, or to the file of --summary: {"users": 3, "matches": {"mijn-1": 2, ...}}.
+
+    python -m tips.bulk users.ndjson > tips.ndjson
+    cat users.ndjson | python -m tips.bulk --workers 4 --output tips.ndjson --summary summary.json
+"""
+import argparse
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from tips.api.json_backend import dumps, loads
+from tips.api.tip_generator import tips_generator_batch, encode_response, TIPS_POOL, INCOME_TIPS_POOL
+
+POOLS = [TIPS_POOL, INCOME_TIPS_POOL]
+
+
+def read_chunks(lines, size):
+    """ Yields lists of at most `size` non empty lines. """
+    lines = (line for line in lines if line.strip())
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def process_chunk(lines, pool=TIPS_POOL):
+    """ Returns the results for a chunk of NDJSON lines. """
+    return tips_generator_batch([loads(line) for line in lines], pool=pool)
+
+
+def process_chunks(chunks, pool=TIPS_POOL, workers=1):
+    """
+    Yields the results of every chunk, in order. With more than one worker the chunks are processed in a pool of
+    processes, with at most two chunks per worker in flight so the input is not read ahead any further.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield process_chunk(chunk, pool)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(process_chunk, chunk, pool))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def generate(lines, output, pool=TIPS_POOL, workers=1, chunk_size=100, summary=None):
+    """
+    Writes the results for the NDJSON user data in `lines` to `output`, returns the number of matches per tip.
+    The number of users and the matches per tip are written to `summary` when it is given.
+    """
+    users = 0
+    matches = Counter()
+    for results in process_chunks(read_chunks(lines, chunk_size), pool, workers):
+        for result in results:
+            users += 1
+            matches.update(tip['id'] for tip in result['items'])
+            output.write(encode_response(result).decode())
+            output.write('\n')
+
+    if summary is not None:
+        summary.write(dumps({"users": users, "matches": dict(matches.most_common())}).decode())
+        summary.write('\n')
+    return matches
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+                        help="NDJSON file with user data (default: stdin)")
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout, help="default: stdout")
+    parser.add_argument('--summary', type=argparse.FileType('w'), default=sys.stderr,
+                        help="where to write the number of users and matches per tip (default: stderr)")
+    parser.add_argument('--pool', choices=POOLS, default=TIPS_POOL)
+    parser.add_argument('--workers', type=int, default=1, help="number of processes")
+    parser.add_argument('--chunk-size', type=int, default=100, help="users per chunk of work")
+    args = parser.parse_args(argv)
+
+    generate(args.input, args.output, args.pool, args.workers, args.chunk_size, args.summary)
+    args.output.flush()
+    args.summary.flush()
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
@@ -9,3 +9,76 @@ def get_sentry_dsn():
 
 def get_photo_path():
     return os.path.join(PROJECT_PATH, 'static', 'tip_images')
+
+
+def get_reload_interval():
+    return int(os.getenv('TIPS_RELOAD_INTERVAL', 30))
+
+
+def get_result_cache_bytes():
+    return int(os.getenv('TIPS_RESULT_CACHE_BYTES', 0))
+
+
+def get_result_cache_ttl():
+    return int(os.getenv('TIPS_RESULT_CACHE_TTL', 3600))
+
+
+def get_rule_backend():
+    # objectpath, native or differential
+    return os.getenv('TIPS_RULE_BACKEND', 'objectpath')
+
+
+def get_json_backend():
+    # auto (orjson when it is installed), orjson or json
+    return os.getenv('TIPS_JSON_BACKEND', 'auto')
+
+
+def get_image_sendfile():
+    # none, x-sendfile or x-accel-redirect
+    return os.getenv('TIPS_IMAGE_SENDFILE', 'none')
+
+
+def get_image_accel_prefix():
+    # the internal location of the images in nginx, for x-accel-redirect
+    return os.getenv('TIPS_IMAGE_ACCEL_PREFIX', '/tip_images/')
+
+
+def get_max_body_bytes():
+    return int(os.getenv('TIPS_MAX_BODY_BYTES', 2 * 1024 * 1024))
+
+
+def get_max_batch_body_bytes():
+    return int(os.getenv('TIPS_MAX_BATCH_BODY_BYTES', 32 * 1024 * 1024))
+
+
+def get_max_json_depth():
+    return int(os.getenv('TIPS_MAX_JSON_DEPTH', 32))
+
+
+def get_max_array_length():
+    return int(os.getenv('TIPS_MAX_ARRAY_LENGTH', 10000))
+
+
+def get_asgi_workers():
+    # threads which run the rules when serving with ASGI
+    return int(os.getenv('TIPS_ASGI_WORKERS', 4))
+
+
+def get_asgi_queue():
+    # requests which can wait for one of those threads, the ones after that are rejected
+    return int(os.getenv('TIPS_ASGI_QUEUE', 64))
+
+
+def get_metrics_sample_rate():
+    # part of the evaluations which is timed for /status/metrics, 0 disables it
+    return float(os.getenv('TIPS_METRICS_SAMPLE_RATE', 0))
+
+
+def get_now():
+    # the moment the rules see as now() at startup, for testing, like 2030-01-01T12:00:00Z
+    return os.getenv('TIPS_NOW')
+
+
+def get_preload_freeze():
+    # move the objects of the preloaded application out of reach of the garbage collector, see tips/preload.py
+    return os.getenv('TIPS_PRELOAD_FREEZE', '1') == '1'
@@ -0,0 +1,91 @@
+"""
+The time of now() in the rules. TIPS_NOW moves it to another moment for testing, like TIPS_NOW=2030-01-01T12:00:00Z,
+from where it keeps running. Both objectpath and the native rules get now() from here.
+"""
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+
+from objectpath.utils import timeutils
+
+from tips.config import get_now
+
+# now() of objectpath itself
+_now = timeutils.now
+_local = threading.local()
+
+# the dates which are compared with a cutoff, outside of this range the comparison itself runs
+FIRST_DAY = date(1800, 1, 1)
+LAST_DAY = date(2200, 1, 1)
+
+
+def parse_moment(value):
+    """ An aware datetime of an ISO 8601 moment, without a timezone it is in UTC. """
+    moment = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=timezone.utc)
+
+
+def _offset_to(moment):
+    return moment - datetime.now(timezone.utc)
+
+
+OFFSET = _offset_to(parse_moment(get_now())) if get_now() else timedelta(0)
+
+
+def _offset():
+    moment = getattr(_local, 'moment', None)
+    # within at() the clock stands still
+    return OFFSET if moment is None else _offset_to(moment)
+
+
+def now():
+    """ now() of the rules. """
+    offset = _offset()
+    value = _now()
+    return value + offset if offset else value
+
+
+def utcnow():
+    return datetime.now(timezone.utc) + _offset()
+
+
+def today():
+    """ The date at now() in UTC, the day of every daily cutoff. """
+    return utcnow().date()
+
+
+@contextmanager
+def at(moment):
+    """ Runs the rules in this thread as if it is `moment` (an aware datetime), the time does not pass meanwhile. """
+    previous = getattr(_local, 'moment', None)
+    _local.moment = moment
+    try:
+        yield
+    finally:
+        _local.moment = previous
+
+
+def bisect_cutoff(matches, first, last, ascending):
+    """
+    The first of the numbers first to last (days or seconds) for which matches() is true when its outcome changes once,
+    from false to true as the number increases (ascending), otherwise the last one. Beyond the range when it never
+    matches within it.
+    """
+    if ascending:
+        first, last = last, first
+    if not matches(first):
+        return first + 1 if ascending else first - 1
+    if matches(last):
+        return last
+
+    # first always matches, last never
+    while abs(last - first) > 1:
+        middle = (first + last) // 2
+        if matches(middle):
+            first = middle
+        else:
+            last = middle
+    return first
+
+
+timeutils.now = now
@@ -0,0 +1,431 @@
+"""
+Evaluates rules for a whole population at once, for questions like how many residents would see a tip.
+
+The user data is turned into columns and the common rule shapes into NumPy operations on those columns:
+
+* rules which do not read the user data, like `now() < datetime(2019, 9, 1)`, are executed once
+* date comparisons, like `dateTime($.brp.persoon.geboortedatum) + timeDelta(18, 0, 0, 0, 0, 0) <= now()`, become a
+  comparison with a threshold date. The threshold is found by bisection with the rule engine itself, so it follows
+  the date arithmetic of objectpath exactly.
+* other rules which read a single path, like `$.brp.persoon.mokum is true`, are executed once per distinct value
+* `len($.brp.kinderen[...]) >= 1` and `$.brp.persoon.nationaliteiten[...]` count the elements which pass the filter,
+  with the conditions in the filter evaluated in the same way over a column of all elements
+
+Users for whom a rule can not be evaluated like this, for example because a date is not in the usual format, fall back
+to the rule engine for that rule, so the outcome is always the same as that of apply_rules.
+
+Needs numpy, which is not a requirement of the service itself, see requirements-analytics.txt.
+"""
+import json
+import re
+from datetime import datetime, time, timedelta
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+from objectpath import ExecutionError, Tree
+
+from tips.generator import clock
+from tips.generator.native import date_comparison, to_source, reads_data, CURRENT, ROOT
+from tips.generator.rule_engine import compile_rule, is_match, static_path, CompoundRuleCycleError, RuleCompileError
+
+_COMPARISONS = {'<', '<=', '>', '>='}
+_CONDITIONS = _COMPARISONS | {'is', 'is not', 'in', 'not in'}
+
+# the dates which are compared with a threshold, outside of this range the rule engine is used
+_EPOCH = datetime(1970, 1, 1)
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+_DATE = re.compile(r'\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ')
+_MIN_SECONDS = int((datetime.combine(clock.FIRST_DAY, time()) - _EPOCH).total_seconds())
+_MAX_SECONDS = int((datetime.combine(clock.LAST_DAY, time()) - _EPOCH).total_seconds())
+
+
+def _has_filter(tree):
+    return type(tree) is tuple and bool(tree) and (tree[0] == '[' or any(_has_filter(node) for node in tree[1:]))
+
+
+def _with_current_as_root(tree):
+    """ A condition on @ as a rule on $, to evaluate it with the element as the user data. """
+    if tree == CURRENT:
+        return ROOT
+    if type(tree) is not tuple:
+        return tree
+    return tuple(_with_current_as_root(node) for node in tree)
+
+
+def _conditions(tree):
+    """ The conditions of a filter which are combined with `and`. """
+    if type(tree) is tuple and tree and tree[0] == 'and':
+        return _conditions(tree[1]) + _conditions(tree[2])
+    return [tree]
+
+
+def _lookup(data, path):
+    """
+    Follows the path as far as possible, returns how many of its keys were found and the value there. That is the
+    value at path when all keys were found, otherwise an object without the next key or something which is not an object.
+    """
+    value = data
+    for depth, key in enumerate(path):
+        if type(value) is not dict or key not in value:
+            return depth, value
+        value = value[key]
+    return len(path), value
+
+
+def _with_value(path, found):
+    """ User data with only the result of _lookup at path. """
+    depth, value = found
+    if depth < len(path) and type(value) is dict:
+        # the rest of the object does not matter
+        value = {}
+    for key in reversed(path[:depth]):
+        value = {key: value}
+    return value
+
+
+def _seconds(value):
+    if type(value) is not str or not _DATE.fullmatch(value):
+        return None
+    try:
+        seconds = int((datetime.strptime(value, _DATE_FORMAT) - _EPOCH).total_seconds())
+    except ValueError:
+        return None
+    if _MIN_SECONDS <= seconds <= _MAX_SECONDS:
+        return seconds
+    return None
+
+
+def _format_date(seconds):
+    return (_EPOCH + timedelta(seconds=seconds)).strftime(_DATE_FORMAT)
+
+
+def _execute(compiled, data, in_filter=False):
+    """
+    Like rule_engine._apply_rule, None when it raises something else than an ExecutionError. Within a filter objectpath
+    leaves out the elements for which the condition raises anything.
+    """
+    try:
+        return is_match(compiled.execute(Tree(data)))
+    except ExecutionError:
+        return False
+    except Exception:
+        return False if in_filter else None
+
+
+class _RuleRaised(Exception):
+    pass
+
+
+def _matches_at(compiled, path, seconds, in_filter):
+    """ Whether the rule matches for user data with only this date at path. """
+    result = _execute(compiled, _with_value(path, (len(path), _format_date(seconds))), in_filter)
+    if result is None:
+        raise _RuleRaised()
+    return result
+
+
+def _threshold(compiled, path, ascending, in_filter):
+    """
+    The first date (in seconds) for which the rule matches when it matches from some date onwards (ascending) or
+    the last date when it matches up to some date. None when the rule raises.
+    """
+    try:
+        return clock.bisect_cutoff(lambda seconds: _matches_at(compiled, path, seconds, in_filter),
+                                   _MIN_SECONDS, _MAX_SECONDS, ascending)
+    except _RuleRaised:
+        return None
+
+
+class Table:
+    """ The user data of a population, with the columns and rule outcomes which are computed for it. """
+
+    def __init__(self, datas, in_filter=False):
+        self.datas = datas
+        # whether the rows are the elements a filter condition is evaluated for
+        self.in_filter = in_filter
+        self.size = len(datas)
+        self._columns = {}
+        self._dates = {}
+        self._elements = {}
+        self._outcomes = {}
+
+    def column(self, path):
+        """ The result of _lookup for every row. """
+        column = self._columns.get(path)
+        if column is None:
+            column = self._columns[path] = [_lookup(data, path) for data in self.datas]
+        return column
+
+    def dates(self, path):
+        """ The dates at path in seconds, and for which rows that is known. """
+        dates = self._dates.get(path)
+        if dates is None:
+            seconds = [_seconds(value) if depth == len(path) else None for (depth, value) in self.column(path)]
+            known = np.array([s is not None for s in seconds], dtype=bool)
+            values = np.array([s if s is not None else 0 for s in seconds], dtype=np.int64)
+            dates = self._dates[path] = (values, known)
+        return dates
+
+    def elements(self, path):
+        """
+        A Table of the elements of the lists at path, with the row every element belongs to and which rows are known:
+        the ones where it is a list of objects.
+        """
+        elements = self._elements.get(path)
+        if elements is None:
+            datas = []
+            owners = []
+            known = np.zeros(self.size, dtype=bool)
+            for row, (depth, value) in enumerate(self.column(path)):
+                if depth == len(path) and type(value) is list and all(type(e) is dict for e in value):
+                    known[row] = True
+                    datas.extend(value)
+                    owners.extend([row] * len(value))
+            elements = self._elements[path] = (Table(datas, True), np.array(owners, dtype=np.int64), known)
+        return elements
+
+    def outcome(self, compiled):
+        """ The outcome of the rule for every row and for which rows that is known. """
+        outcome = self._outcomes.get(compiled.source)
+        if outcome is None:
+            outcome = self._outcomes[compiled.source] = _vectorize(self, compiled)
+        return outcome
+
+
+def _vectorize(table, compiled):
+    for translate in (_constant, _date_comparison, _filter_count, _by_value):
+        outcome = translate(table, compiled)
+        if outcome is not None:
+            return outcome
+    return np.zeros(table.size, dtype=bool), np.zeros(table.size, dtype=bool)
+
+
+def _constant(table, compiled):
+    """ Rules which do not read the user data. """
+    if compiled.paths or reads_data(compiled.tree):
+        return None
+    result = _execute(compiled, {}, table.in_filter)
+    if result is None:
+        return None
+    return np.full(table.size, result, dtype=bool), np.ones(table.size, dtype=bool)
+
+
+def _date_comparison(table, compiled):
+    """ Rules like `dateTime($.path) + timeDelta(...) <= now()`, the outcome only changes once as the date increases. """
+    comparison = date_comparison(compiled.tree)
+    if comparison is None or comparison[0] != ROOT:
+        return None
+    _, path, ascending = comparison
+
+    threshold = _threshold(compiled, path, ascending, table.in_filter)
+    if threshold is None:
+        return None
+    values, known = table.dates(path)
+    outcome = (values >= threshold) if ascending else (values <= threshold)
+    # the values which are no dates in the usual format, like null, by value
+    others = _by_value(table, compiled, ~known)
+    if others is None:
+        return outcome, known.copy()
+    return np.where(known, outcome, others[0]), known | others[1]
+
+
+_COUNT_COMPARISONS = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def _counted_selection(tree):
+    """
+    Returns the filter, comparison and number of `len($.list[...]) >= 1`. A filter on its own, like `$.list[...]`,
+    matches when any element passes.
+    """
+    if type(tree) is not tuple or not tree:
+        return None
+    if tree[0] == '[':
+        return tree, '>', 0
+    if tree[0] not in _COUNT_COMPARISONS or len(tree) != 3 or type(tree[2]) is not int:
+        return None
+    counted = tree[1]
+    if type(counted) is not tuple or counted[:2] != ('fn', 'len') or len(counted) != 3:
+        return None
+    if type(counted[2]) is not tuple or counted[2][0] != '[':
+        return None
+    return counted[2], tree[0], tree[2]
+
+
+def _filter_conditions(tree):
+    """ The conditions of a filter, compiled as rules on the elements. None when they are not simple conditions. """
+    conditions = []
+    for condition in _conditions(tree):
+        if type(condition) is not tuple or condition[0] not in _CONDITIONS or _has_filter(condition):
+            return None
+        try:
+            conditions.append(compile_rule(to_source(_with_current_as_root(condition))))
+        except (ValueError, RuleCompileError):
+            return None
+    return conditions
+
+
+def _filter_count(table, compiled):
+    """ Rules like `len($.list[...]) >= 1` and `$.list[...]`, counts the elements of every row which pass the filter. """
+    counted = _counted_selection(compiled.tree)
+    if counted is None or len(counted[0]) != 3:
+        return None
+    (_, selected, condition), compare, number = counted
+    if type(selected) is tuple and len(selected) == 3 and selected[0] == '.' and selected[2] == ('*',):
+        # like `$.focus.*`, which is the list itself when it is a list of objects
+        selected = selected[1]
+    path = static_path(selected)
+    conditions = _filter_conditions(condition)
+    if not path or conditions is None:
+        return None
+
+    elements, owners, known = table.elements(path)
+    known = known.copy()
+    passed = np.ones(elements.size, dtype=bool)
+    for condition in conditions:
+        outcome, element_known = elements.outcome(condition)
+        # an element which can not be evaluated makes its row unknown, unless an earlier condition left it out
+        known[owners[passed & ~element_known]] = False
+        passed &= outcome
+
+    counts = np.bincount(owners[passed], minlength=table.size)
+    return _COUNT_COMPARISONS[compare](counts, number), known
+
+
+def _by_value(table, compiled, rows=None):
+    """ Rules which read a single path are executed once for every distinct value at that path, for the selected rows. """
+    if len(compiled.paths) != 1:
+        return None
+    ((path, fields),) = compiled.paths.items()
+    if not path:
+        return None
+
+    column = table.column(path)
+    codes = {}
+    samples = []
+    # rows which are not selected index the unknown outcome at the end
+    indexes = np.full(table.size, -1, dtype=np.int64)
+    for row in (range(table.size) if rows is None else np.flatnonzero(rows)):
+        found = column[row]
+        try:
+            key = json.dumps(_key(path, found, fields), sort_keys=True)
+        except (TypeError, ValueError):
+            continue
+        code = codes.get(key)
+        if code is None:
+            code = codes[key] = len(samples)
+            samples.append(found)
+        indexes[row] = code
+
+    results = [_execute(compiled, _with_value(path, found), table.in_filter) for found in samples]
+    outcomes = np.array([bool(result) for result in results] + [False], dtype=bool)
+    knowns = np.array([result is not None for result in results] + [False], dtype=bool)
+    return outcomes[indexes], knowns[indexes]
+
+
+def _key(path, found, fields):
+    """ The part of the value found at (or on the way to) path which the rule depends on, see rule_engine.read_paths. """
+    depth, value = found
+    if depth < len(path):
+        return [depth, {} if type(value) is dict else value]
+    if fields is not None and type(value) is list:
+        value = [
+            {'fields': [_key(field, _lookup(element, field), None) for field in sorted(fields)]}
+            if type(element) is dict else element
+            for element in value
+        ]
+    return [depth, value]
+
+
+class ColumnarEvaluator:
+    """ Evaluates tips and compound rules for all rows of a Table, falling back to the rule engine per rule and row. """
+
+    def __init__(self, table, compound_rules):
+        self.table = table
+        self.compound_rules = compound_rules
+        self._trees = {}
+        self._compound_results = {}
+        self._evaluating = set()
+
+    def _fallback(self, compiled, outcome, known, rows):
+        for row in np.flatnonzero(rows):
+            tree = self._trees.get(row)
+            if tree is None:
+                tree = self._trees[row] = Tree(self.table.datas[row])
+            try:
+                outcome[row] = is_match(compiled.execute(tree))
+            except ExecutionError:
+                outcome[row] = False
+            known[row] = True
+
+    def _apply_rule(self, rule, rows):
+        if rule['type'] == "rule":
+            compiled = compile_rule(rule['rule'])
+            outcome, known = self.table.outcome(compiled)
+            missing = rows & ~known
+            if missing.any():
+                self._fallback(compiled, outcome, known, missing)
+            return outcome
+
+        if rule['type'] == "ref":
+            return self.apply_compound_rule(rule['ref_id'], rows)
+        return np.zeros(self.table.size, dtype=bool)
+
+    def apply_rules(self, rules, rows=None):
+        """ Like rule_engine.apply_rules for the selected rows, the rows which are not selected are False. """
+        passed = np.ones(self.table.size, dtype=bool) if rows is None else rows.copy()
+        for rule in rules:
+            if not passed.any():
+                break
+            # like apply_rules, a rule only runs for the rows which passed the rules before it
+            passed &= self._apply_rule(rule, passed)
+        return passed
+
+    def apply_compound_rule(self, ref_id, rows=None):
+        if rows is None:
+            rows = np.ones(self.table.size, dtype=bool)
+        results = self._compound_results.get(ref_id)
+        if results is None:
+            results = self._compound_results[ref_id] = (
+                np.zeros(self.table.size, dtype=bool), np.zeros(self.table.size, dtype=bool)
+            )
+        outcome, done = results
+
+        missing = rows & ~done
+        if missing.any():
+            if ref_id in self._evaluating:
+                raise CompoundRuleCycleError(f"Compound rule {ref_id!r} refers to itself")
+            self._evaluating.add(ref_id)
+            try:
+                outcome[missing] = self.apply_rules(self.compound_rules[ref_id]['rules'], missing)[missing]
+            finally:
+                self._evaluating.discard(ref_id)
+            done |= missing
+        return outcome
+
+    def tip_filter(self, tip):
+        """ Like tip_generator.tip_filter. """
+        if not tip['active']:
+            return np.zeros(self.table.size, dtype=bool)
+        return self.apply_rules(tip.get('rules', []))
+
+
+def match_bitmaps(datas, tips, compound_rules):
+    """
+    Returns for every tip and compound rule which of the users in `datas` (the user_data['data'] of every user) it
+    matches, as boolean arrays: {"tips": {tip id: array}, "compound_rules": {ref_id: array}}.
+    """
+    if np is None:
+        raise ImportError("The columnar evaluator needs numpy")
+    evaluator = ColumnarEvaluator(Table(datas), compound_rules)
+    return {
+        "tips": {tip['id']: evaluator.tip_filter(tip) for tip in tips},
+        "compound_rules": {ref_id: evaluator.apply_compound_rule(ref_id).copy() for ref_id in compound_rules},
+    }
@@ -0,0 +1,124 @@
+"""
+Timings of the rules, compound rules and tips, for /status/metrics. TIPS_METRICS_SAMPLE_RATE is the part of the
+evaluations which is measured: 0 (the default) measures nothing, 1 every evaluation and 0.01 one in a hundred.
+The number of rules executed and skipped by short-circuiting is counted for every user.
+Every process keeps its own metrics.
+"""
+import random
+import threading
+import time
+
+from tips.config import get_metrics_sample_rate
+
+# what is measured, a rule by its text, a compound rule by its ref_id and a tip by its id
+RULE = 'rule'
+COMPOUND_RULE = 'compound_rule'
+TIP = 'tip'
+
+SAMPLE_RATE = get_metrics_sample_rate()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+clock = time.perf_counter
+
+
+class Stats:
+    __slots__ = ('evaluations', 'seconds', 'max_seconds', 'matches', 'errors')
+
+    def __init__(self):
+        self.evaluations = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.matches = 0
+        self.errors = 0
+
+
+_stats = {}  # Stats per (kind, key)
+# the rules executed for all users and the ones skipped because an earlier rule of the same list failed, not sampled
+_rule_counts = {'evaluated': 0, 'skipped': 0}
+_lock = threading.Lock()
+
+
+def sampled():
+    """ Whether to measure the evaluations for a user, decided once per user. """
+    return SAMPLE_RATE > 0 and (SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE)
+
+
+def observe(kind, key, seconds, matched, error=False):
+    with _lock:
+        stats = _stats.get((kind, key))
+        if stats is None:
+            stats = _stats[(kind, key)] = Stats()
+        stats.evaluations += 1
+        stats.seconds += seconds
+        if seconds > stats.max_seconds:
+            stats.max_seconds = seconds
+        if matched:
+            stats.matches += 1
+        if error:
+            stats.errors += 1
+
+
+def count_rules(evaluated, skipped):
+    """ Adds the rules executed and skipped for a user, from its EvaluationContext. """
+    with _lock:
+        _rule_counts['evaluated'] += evaluated
+        _rule_counts['skipped'] += skipped
+
+
+def get_rule_counts():
+    with _lock:
+        return dict(_rule_counts)
+
+
+def get_stats():
+    """ Returns a copy of the Stats per (kind, key). """
+    with _lock:
+        items = list(_stats.items())
+    copies = {}
+    for key, stats in items:
+        copy = copies[key] = Stats()
+        for name in Stats.__slots__:
+            setattr(copy, name, getattr(stats, name))
+    return copies
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _rule_counts.update(evaluated=0, skipped=0)
+
+
+# name, type, help and the Stats field of every metric
+_METRICS = [
+    ('tips_evaluations_total', 'counter', 'Measured evaluations.', 'evaluations'),
+    ('tips_evaluation_seconds_total', 'counter', 'Total time of the measured evaluations.', 'seconds'),
+    ('tips_evaluation_seconds_max', 'gauge', 'Longest measured evaluation.', 'max_seconds'),
+    ('tips_matches_total', 'counter', 'Measured evaluations which matched.', 'matches'),
+    ('tips_execution_errors_total', 'counter', 'Measured evaluations which raised an ExecutionError.', 'errors'),
+]
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus():
+    """ The metrics in the Prometheus text format. """
+    stats = sorted(get_stats().items())
+    counts = get_rule_counts()
+    lines = ['# HELP tips_metrics_sample_rate Part of the evaluations which is measured.',
+             '# TYPE tips_metrics_sample_rate gauge',
+             f'tips_metrics_sample_rate {SAMPLE_RATE}',
+             '# HELP tips_rules_evaluated_total Rules executed, for all users.',
+             '# TYPE tips_rules_evaluated_total counter',
+             f'tips_rules_evaluated_total {counts["evaluated"]}',
+             '# HELP tips_rules_skipped_total Rules skipped because an earlier rule of a tip or compound rule failed.',
+             '# TYPE tips_rules_skipped_total counter',
+             f'tips_rules_skipped_total {counts["skipped"]}']
+    for name, kind, description, field in _METRICS:
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (what, key), values in stats:
+            lines.append(f'{name}{{type="{what}",id="{_label(key)}"}} {getattr(values, field)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,512 @@
+"""
+Translates rules into plain Python functions over the user data, so they run without the objectpath interpreter.
+
+Only the part of objectpath the rules use is translated: `$.` paths, `.*`, filters like `[@.x is 1]`, comparisons,
+`is`, `in`, `and`, `or`, `not`, arithmetic, `len()`, `now()`, `dateTime()` and functions of constants like
+`timeDelta(18, 0, 0, 0, 0, 0)`, which objectpath evaluates once when the rule is translated. The functions follow the
+objectpath interpreter, quirks included, so they give the same results. Anything else raises NotTranslatable and those
+rules keep running on objectpath.
+
+Comparisons of a date in the user data with now(), like `dateTime($.brp.persoon.geboortedatum) + timeDelta(18, 0, 0, 0,
+0, 0) <= now()`, are turned into a cutoff day once a day, dates at midnight are then compared with it as ISO strings.
+"""
+import datetime
+import operator
+import re
+
+from objectpath.core import ITER_TYPES, NUM_TYPES, STR_TYPES, SELECTOR_OPS, ProgrammingError, generator, chain
+from objectpath.utils import timeutils
+
+from tips.generator import clock
+
+# as in objectpath, used to compare floats
+_EPSILON = 0.0000000000000001
+
+# the values objectpath returns as they are when it executes them
+_VALUE_TYPES = (str, int, float, bool, generator, chain, datetime.time, datetime.date, datetime.datetime)
+
+# the parse tree nodes of $ and @
+ROOT = ('(root)', 'rs')
+CURRENT = ('(current)',)
+_SYMBOLS = {ROOT: '$', CURRENT: '@'}
+_OPERATORS = {'<', '<=', '>', '>=', 'is', 'is not', 'in', 'not in', '+', '-', '*', '/', '%', 'and', 'or'}
+
+# the dates which are compared with a cutoff day, other values run the comparison itself
+_MIDNIGHT = re.compile(r'\d{4}-\d\d-\d\dT00:00:00Z')
+
+
+class NotTranslatable(Exception):
+    pass
+
+
+def _literal_source(value):
+    if value is True or value is False or value is None:
+        return {True: 'true', False: 'false', None: 'null'}[value]
+    if type(value) in (int, float):
+        return repr(value)
+    if type(value) is str and "'" not in value and '\\' not in value:
+        return f"'{value}'"
+    raise ValueError(f"Can not write {value!r}")
+
+
+def _key_source(node):
+    if node == ('*',):
+        return '*'
+    if type(node) is tuple and len(node) == 2 and node[0] == 'name':
+        return node[1]
+    raise ValueError(f"Can not write {node!r}")
+
+
+def to_source(tree):
+    """ Returns the rule text of a parsed rule, raises ValueError for parts of objectpath the rules do not use. """
+    if type(tree) is not tuple:
+        return _literal_source(tree)
+    if tree in _SYMBOLS:
+        return _SYMBOLS[tree]
+
+    op, *args = tree
+    if op == 'name' and len(args) == 1:
+        return args[0]
+    if op == 'fn' and type(args[0]) is str:
+        return f"{args[0]}({', '.join(to_source(arg) for arg in args[1:])})"
+    if op == '.' and len(args) == 2:
+        return f"{to_source(args[0])}.{_key_source(args[1])}"
+    if op == '[' and len(args) == 2:
+        return f"{to_source(args[0])}[{to_source(args[1])}]"
+    if op == 'not' and len(args) == 1 or op in _OPERATORS and len(args) == 2:
+        parts = [to_source(arg) for arg in args]
+        # `not a` or `a op b`
+        parts.insert(len(parts) - 1, op)
+        return f"({' '.join(parts)})"
+    raise ValueError(f"Can not write {tree!r}")
+
+
+def reads_data(tree):
+    """ Whether a parsed rule reads the user data ($ or @). """
+    if tree == ROOT or tree == CURRENT:
+        return True
+    return type(tree) is tuple and any(reads_data(node) for node in tree[1:])
+
+
+def _reexecute(value):
+    """ objectpath executes the values of a filter condition once more, this does the same. """
+    kind = type(value)
+    if value is None or kind in _VALUE_TYPES:
+        return value
+    if kind is list:
+        return (_reexecute(v) for v in value)
+    if kind is dict:
+        return {_reexecute(k): _reexecute(v) for (k, v) in value.items()}
+    raise TypeError(f"'{kind.__name__}' object is not subscriptable")
+
+
+def _add_to_object(fst, snd):
+    try:
+        fst.update(snd)
+    except Exception:
+        if type(snd) is not dict:
+            raise ProgrammingError(f"Can't add value of type {type(snd).__name__} to object")
+    return fst
+
+
+def _add_values(fst, snd):
+    typefst, typesnd = type(fst), type(snd)
+    if typefst in NUM_TYPES:
+        try:
+            return fst + snd
+        except Exception:
+            return fst + float(snd)
+    if typefst in STR_TYPES or typesnd in STR_TYPES:
+        return str(fst) + str(snd)
+    if typefst is datetime.time and typesnd is datetime.time:
+        try:
+            return timeutils.addTimes(fst, snd)
+        except Exception:
+            pass
+    return fst + snd
+
+
+def _add(fst, snd):
+    if None in (fst, snd):
+        return fst or snd
+    typefst, typesnd = type(fst), type(snd)
+    if typefst is dict:
+        return _add_to_object(fst, snd)
+    if typefst is list and typesnd is list:
+        return fst + snd
+    if typefst in ITER_TYPES or typesnd in ITER_TYPES:
+        return chain(fst if typefst in ITER_TYPES else [fst], snd if typesnd in ITER_TYPES else [snd])
+    return _add_values(fst, snd)
+
+
+def _subtract(fst, snd):
+    try:
+        return fst - snd
+    except Exception:
+        if type(fst) is datetime.time and type(snd) is datetime.time:
+            return timeutils.subTimes(fst, snd)
+        return None
+
+
+def _same(fst, snd):
+    """ The outcome of `is` for values which are not equal, None when objectpath does not compare their types. """
+    typefst, typesnd = type(fst), type(snd)
+    if typefst in STR_TYPES:
+        return fst == str(snd)
+    if typefst is float or typesnd is float:
+        return abs(float(fst) - float(snd)) < _EPSILON
+    if typefst is int or typesnd is int:
+        return int(fst) == int(snd)
+    if typefst is typesnd and typefst in (list, dict):
+        return fst == snd
+    return None
+
+
+def _is(fst, snd):
+    if fst == snd:
+        return True
+    return _same(fst, snd)
+
+
+def _is_not(fst, snd):
+    same = _same(fst, snd)
+    return False if same is None else not same
+
+
+def _in(fst, snd):
+    if type(fst) in ITER_TYPES and type(snd) in ITER_TYPES:
+        return any(x in max(fst, snd, key=len) for x in min(fst, snd, key=len))
+    return fst in snd
+
+
+def _not_in(fst, snd):
+    if type(fst) in ITER_TYPES and type(snd) in ITER_TYPES:
+        return not any(x in max(fst, snd, key=len) for x in min(fst, snd, key=len))
+    return fst not in snd
+
+
+def _len(value):
+    if value in (True, False, None):
+        return value
+    if type(value) in ITER_TYPES:
+        return len(list(value))
+    return len(value)
+
+
+def _get(value, key):
+    """ `value.key` """
+    if type(value) in ITER_TYPES:
+        return (e[key] for e in value if type(e) is dict and key in e)
+    try:
+        return value.get(key)
+    except Exception:
+        try:
+            return value.__getattribute__(key)
+        except AttributeError:
+            return value
+
+
+_OPERATIONS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '>=': operator.ge,
+    '<=': operator.le,
+    'is': _is,
+    'is not': _is_not,
+    'in': _in,
+    'not in': _not_in,
+    '*': operator.mul,
+    '%': operator.mod,
+    '/': lambda fst, snd: fst / float(snd),
+}
+
+
+def _reexecuted(operation):
+    return lambda fst, snd: operation(_reexecute(fst), _reexecute(snd))
+
+
+# a filter condition executes its operands and then the operation on those values
+_CONDITIONS = {op: _reexecuted(operation) for (op, operation) in _OPERATIONS.items() if op in SELECTOR_OPS}
+_CONDITIONS['and'] = lambda fst, snd: _reexecute(fst) and _reexecute(snd)
+_CONDITIONS['or'] = lambda fst, snd: _reexecute(fst) or _reexecute(snd)
+
+
+def _constant(value):
+    return lambda root, current: value
+
+
+def _node(tree, constant, in_filter):
+    """ Returns a function of the user data and the current element (@) which executes this part of a rule. """
+    if type(tree) is not tuple:
+        if tree is not None and type(tree) not in _VALUE_TYPES:
+            raise NotTranslatable(f"Literal {tree!r}")
+        return _constant(tree)
+    translate = _TRANSLATORS.get(tree[0])
+    if translate is None:
+        raise NotTranslatable(f"Operator {tree[0]!r}")
+    return translate(tree, constant, in_filter)
+
+
+def _operands(tree, constant, in_filter, count):
+    if len(tree) != count + 1:
+        raise NotTranslatable(f"Operator {tree[0]!r} with {len(tree) - 1} operands")
+    return [_node(operand, constant, in_filter) for operand in tree[1:]]
+
+
+def _translate_root(tree, constant, in_filter):
+    return lambda root, current: root
+
+
+def _translate_current(tree, constant, in_filter):
+    if not in_filter:
+        # objectpath keeps @ at the element of the last filter
+        raise NotTranslatable("@ outside of a filter")
+    return lambda root, current: current
+
+
+def _translate_name(tree, constant, in_filter):
+    return _constant(tree[1])
+
+
+def _translate_and(tree, constant, in_filter):
+    first, second = _operands(tree, constant, in_filter, 2)
+    return lambda root, current: first(root, current) and second(root, current)
+
+
+def _translate_or(tree, constant, in_filter):
+    first, second = _operands(tree, constant, in_filter, 2)
+    return lambda root, current: first(root, current) or second(root, current)
+
+
+def _translate_not(tree, constant, in_filter):
+    (operand,) = _operands(tree, constant, in_filter, 1)
+    return lambda root, current: not operand(root, current)
+
+
+def _translate_add(tree, constant, in_filter):
+    if len(tree) == 2:
+        return _node(tree[1], constant, in_filter)
+    first, second = _operands(tree, constant, in_filter, 2)
+    return lambda root, current: _add(first(root, current), second(root, current))
+
+
+def _translate_subtract(tree, constant, in_filter):
+    if len(tree) == 2:
+        (operand,) = _operands(tree, constant, in_filter, 1)
+        return lambda root, current: -operand(root, current)
+    first, second = _operands(tree, constant, in_filter, 2)
+    return lambda root, current: _subtract(first(root, current), second(root, current))
+
+
+def _translate_operation(tree, constant, in_filter):
+    operation = _OPERATIONS[tree[0]]
+    first, second = _operands(tree, constant, in_filter, 2)
+
+    def compare(root, current):
+        return operation(first(root, current), second(root, current))
+    return _with_cutoff(tree, compare) or compare
+
+
+def _translate_get(tree, constant, in_filter):
+    if len(tree) != 3 or type(tree[2]) is not tuple:
+        raise NotTranslatable(f"Path {tree!r}")
+    # objectpath only executes the left side when it is an expression
+    value = _node(tree[1], constant, in_filter) if type(tree[1]) is tuple else _constant(tree[1])
+    if tree[2] == ('*',):
+        return value
+    if tree[2][0] != 'name' or len(tree[2]) != 2:
+        raise NotTranslatable(f"Path {tree!r}")
+    key = tree[2][1]
+    return lambda root, current: _get(value(root, current), key)
+
+
+def _selected(values, root, test):
+    for value in values:
+        try:
+            if test(root, value):
+                yield value
+        except Exception:
+            # objectpath leaves out the elements for which the condition raises
+            pass
+
+
+def _translate_filter(tree, constant, in_filter):
+    selector = tree[2] if len(tree) == 3 else None
+    if in_filter or type(selector) is not tuple or selector[0] not in _CONDITIONS or len(selector) != 3:
+        # a nested filter changes @ while objectpath evaluates the condition
+        raise NotTranslatable(f"Filter {tree!r}")
+    selection = _node(tree[1], constant, False)
+    condition = _CONDITIONS[selector[0]]
+    first = _node(selector[1], constant, True)
+    second = _node(selector[2], constant, True)
+
+    def compare(root, current):
+        return condition(first(root, current), second(root, current))
+    test = _with_cutoff(selector, compare) or compare
+
+    def select(root, current):
+        values = selection(root, current)
+        if not values:
+            return values
+        if type(values) is dict:
+            values = [values]
+        return _selected(values, root, test)
+    return select
+
+
+def _translate_function(tree, constant, in_filter):
+    name, arguments = tree[1], tree[2:]
+    if name != 'now' and arguments and not any(type(argument) is tuple for argument in arguments):
+        # like timeDelta(18, 0, 0, 0, 0, 0), execute it once with objectpath
+        try:
+            value = constant(tree)
+        except Exception as e:
+            raise NotTranslatable(f"Function {name!r}: {e!r}") from e
+        if type(value) in ITER_TYPES or type(value) in (dict, list):
+            raise NotTranslatable(f"Function {name!r} returns {type(value).__name__}")
+        return _constant(value)
+
+    if name == 'now' and not arguments:
+        return lambda root, current: timeutils.now()
+    if name in ('len', 'count') and len(arguments) == 1:
+        operand = _node(arguments[0], constant, in_filter)
+        return lambda root, current: _len(operand(root, current))
+    if name == 'dateTime':
+        operands = [_node(argument, constant, in_filter) for argument in arguments]
+        return lambda root, current: timeutils.dateTime([operand(root, current) for operand in operands])
+    raise NotTranslatable(f"Function {name!r}")
+
+
+def _path_keys(tree):
+    """ `$` or `@` and the keys of a path like `$.brp.persoon.geboortedatum`, otherwise None. """
+    keys = []
+    while type(tree) is tuple and len(tree) == 3 and tree[0] == '.' and type(tree[2]) is tuple \
+            and len(tree[2]) == 2 and tree[2][0] == 'name':
+        keys.append(tree[2][1])
+        tree = tree[1]
+    if not keys or tree not in (ROOT, CURRENT):
+        return None
+    return tree, tuple(reversed(keys))
+
+
+def _date_path(tree):
+    """ `$` or `@` and the keys of `dateTime($.path)`, optionally plus or minus a constant, otherwise None. """
+    if type(tree) is not tuple or not tree:
+        return None
+    if tree[0] == 'fn' and tree[1] == 'dateTime' and len(tree) == 3:
+        return _path_keys(tree[2])
+    if tree[0] in ('+', '-') and len(tree) == 3 and not reads_data(tree[2]):
+        return _date_path(tree[1])
+    return None
+
+
+class _DateCutoff:
+    """
+    A comparison of a date in the user data with a moment which only depends on now(). Its outcome only changes once
+    as the date increases, so for the dates at midnight (UTC) it matches from a cutoff day onwards (ascending) or up to
+    it. The cutoff is found once a day by bisection with the comparison itself, so it follows the date arithmetic of
+    objectpath exactly, and dates are then compared with it as ISO strings. Other values run the comparison.
+    """
+    def __init__(self, compare, base, keys, ascending):
+        self.compare = compare
+        self.from_root = base == ROOT
+        self.keys = keys
+        self.ascending = ascending
+        self._cutoff = (None, None)  # the day and its cutoff
+
+    def __call__(self, root, current):
+        value = root if self.from_root else current
+        for key in self.keys:
+            if type(value) is not dict:
+                return self.compare(root, current)
+            value = value.get(key)
+        if type(value) is not str or not _MIDNIGHT.fullmatch(value):
+            return self.compare(root, current)
+        cutoff = self.cutoff()
+        day = value[:10]
+        if cutoff is None or not clock.FIRST_DAY.isoformat() <= day <= clock.LAST_DAY.isoformat():
+            return self.compare(root, current)
+        return day >= cutoff if self.ascending else day <= cutoff
+
+    def cutoff(self):
+        """ The cutoff day for today, None when the comparison raises or its outcome changes during the day. """
+        today = clock.today()
+        day, cutoff = self._cutoff
+        if day != today:
+            cutoff = self._find_cutoff(today)
+            self._cutoff = (today, cutoff)
+        return cutoff
+
+    def _find_cutoff(self, today):
+        # the outcome only moves one way as time passes, when it is the same at the end of the day it holds all day
+        end = datetime.datetime.combine(today, datetime.time(), datetime.timezone.utc) \
+            + datetime.timedelta(days=1, milliseconds=-1)
+        try:
+            cutoff = self._bisect()
+            with clock.at(end):
+                last = self._bisect()
+        except Exception:
+            return None
+        return cutoff if cutoff == last else None
+
+    def _matches(self, day):
+        data = f"{datetime.date.fromordinal(day).isoformat()}T00:00:00Z"
+        for key in reversed(self.keys):
+            data = {key: data}
+        return self.compare(data, None) if self.from_root else self.compare(None, data)
+
+    def _bisect(self):
+        """ The first day which matches when ascending, otherwise the last one. """
+        day = clock.bisect_cutoff(self._matches, clock.FIRST_DAY.toordinal(), clock.LAST_DAY.toordinal(), self.ascending)
+        return datetime.date.fromordinal(day).isoformat()
+
+
+def date_comparison(tree):
+    """
+    `$` or `@`, the keys of the path and whether the outcome changes from false to true as the date increases, for a
+    comparison of `dateTime($.path)`, optionally plus or minus a constant, with something which does not read the user
+    data, like now(). Otherwise None.
+    """
+    if type(tree) is not tuple or tree[0] not in ('<', '<=', '>', '>=') or len(tree) != 3:
+        return None
+    left, right = _date_path(tree[1]), _date_path(tree[2])
+    if left is not None and not reads_data(tree[2]):
+        return left + (tree[0] in ('>', '>='),)
+    if right is not None and not reads_data(tree[1]):
+        return right + (tree[0] in ('<', '<='),)
+    return None
+
+
+def _with_cutoff(tree, compare):
+    """ A _DateCutoff for a comparison of a date in the user data with now(), otherwise None. """
+    comparison = date_comparison(tree)
+    if comparison is None:
+        return None
+    base, keys, ascending = comparison
+    return _DateCutoff(compare, base, keys, ascending)
+
+
+_TRANSLATORS = {
+    '(root)': _translate_root,
+    '(current)': _translate_current,
+    'name': _translate_name,
+    'and': _translate_and,
+    'or': _translate_or,
+    'not': _translate_not,
+    '+': _translate_add,
+    '-': _translate_subtract,
+    '.': _translate_get,
+    '[': _translate_filter,
+    'fn': _translate_function,
+    **{op: _translate_operation for op in _OPERATIONS},
+}
+
+
+def translate(tree, constant):
+    """
+    Returns a function which executes the parsed rule on user data (a dict), like Tree(data).execute(rule) does.
+    `constant` executes a parsed rule which does not read the user data with objectpath.
+    Raises NotTranslatable for rules which use parts of objectpath that are not translated.
+    """
+    node = _node(tree, constant, False)
+    return lambda data: node(data, None)
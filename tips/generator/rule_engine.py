@@ -1,23 +1,503 @@
-from objectpath import ExecutionError
+import logging
+import threading
+
+from objectpath import ExecutionError, Tree
 from objectpath.core import generator
 
+from tips.config import get_rule_backend
+from tips.generator import metrics
+from tips.generator.native import translate, to_source, NotTranslatable, ROOT, CURRENT
+
+logger = logging.getLogger(__name__)
+
+# objectpath executes every rule with the objectpath interpreter, native runs the rules translated into Python
+# functions where possible and differential runs both and logs when they disagree
+RULE_BACKENDS = ('objectpath', 'native', 'differential')
+RULE_BACKEND = get_rule_backend()
+if RULE_BACKEND not in RULE_BACKENDS:
+    raise ValueError(f"Unknown rule backend {RULE_BACKEND!r}, use one of {', '.join(RULE_BACKENDS)}")
+
+
+class RuleCompileError(Exception):
+    pass
+
+
+class CompoundRuleCycleError(RecursionError):
+    pass
+
+
+class CompiledRule:
+    """
+    A rule expression which is parsed once and can be executed against any user data tree.
+    `sources` are the top-level keys of the user data the rule reads (None if that can not be determined),
+    `requires` are the sources without which the rule can never match and `paths` are the paths into the user data
+    the outcome of the rule depends on. `native` is the rule translated into a Python function of the user data, or
+    None when the rule uses parts of objectpath which are not translated.
+    """
+    __slots__ = ('source', 'tree', 'native', 'cost', 'sources', 'requires', 'paths')
+
+    def __init__(self, source, tree):
+        self.source = source
+        self.tree = tree
+        try:
+            self.native = translate(tree, _execute_constant)
+        except NotTranslatable:
+            self.native = None
+        self.cost = estimate_cost(tree)
+        self.sources = read_sources(tree)
+        self.paths = read_paths(tree)
+        self.requires = self._required_sources()
+
+    def _required_sources(self):
+        # Only a rule that reads a single source and does not match without it, like `$.brp.persoon.mokum is true`,
+        # requires that source. Something like `not $.erfpacht` matches exactly when the source is absent.
+        if not self.sources or len(self.sources) > 1:
+            return frozenset()
+        try:
+            matches = is_match(self.execute(_empty_tree))
+        except Exception:
+            matches = False
+        return frozenset() if matches else self.sources
+
+    def execute(self, userdata):
+        # Tree.execute() only accepts the expression text. Compiling the rule stored its parsed tree in the
+        # objectpath expression cache under that same text, so this does not tokenize or parse it again.
+        return userdata.execute(self.source)
+
+    def matches(self, userdata):
+        """
+        Whether the rule matches the user data, a UserData or a Tree. Raises what objectpath raises executing it.
+        With the native or differential backend a UserData is matched without building its Tree when possible.
+        """
+        if self.native is None or RULE_BACKEND == 'objectpath' or type(userdata) is not UserData:
+            return is_match(self.execute(userdata if type(userdata) is not UserData else userdata.tree))
+        if RULE_BACKEND == 'native':
+            return is_match(self.native(userdata.data))
+        return self._compare(userdata)
+
+    def _compare(self, userdata):
+        """ Matches with both backends, logs when they disagree and returns the outcome of objectpath. """
+        outcomes = []
+        for match in (lambda: is_match(self.execute(userdata.tree)), lambda: is_match(self.native(userdata.data))):
+            try:
+                outcomes.append((match(), None))
+            except Exception as e:
+                outcomes.append((None, e))
+        (expected, error), (native, native_error) = outcomes
+        if (expected, type(error)) != (native, type(native_error)):
+            logger.warning("Rule %r gives %r with objectpath and %r natively",
+                           self.source, error or expected, native_error or native)
+        if error:
+            raise error
+        return expected
+
+    def __repr__(self):
+        return f"CompiledRule({self.source!r})"
+
+
+# Relative cost of evaluating a node, on top of the cost of its children. Filters run their condition for every
+# element of the list they select from, descendant lookups walk the whole subtree.
+_NODE_COSTS = {
+    '[': 10,
+    '*': 20,
+    '..': 20,
+}
+_FUNCTION_COSTS = {
+    'dateTime': 3,
+    'timeDelta': 2,
+    'now': 2,
+}
+_FILTER_ELEMENTS = 10
+
+
+def estimate_cost(tree):
+    """ Estimate how expensive a parsed rule is to execute, only the relative order of costs matters. """
+    if type(tree) is not tuple or not tree:
+        return 0
+    op = tree[0]
+    if op == 'fn':
+        return 1 + _FUNCTION_COSTS.get(tree[1], 1) + sum(estimate_cost(arg) for arg in tree[2:])
+    if op == '[' and len(tree) == 3:
+        # the condition is executed for every element selected on the left
+        return _NODE_COSTS['['] + estimate_cost(tree[1]) + _FILTER_ELEMENTS * estimate_cost(tree[2])
+    return 1 + _NODE_COSTS.get(op, 0) + sum(estimate_cost(node) for node in tree[1:])
+
+
+def _collect_sources(tree, sources):
+    """ Adds the sources read by this (part of a) parse tree, returns False when the root is used in any other way. """
+    if type(tree) is not tuple or not tree:
+        return True
+    if tree == ROOT:
+        return False
+    if tree[0] == '.' and tree[1] == ROOT:
+        if type(tree[2]) is tuple and tree[2][0] == 'name':
+            sources.add(tree[2][1])
+            return True
+        return False
+    return all(_collect_sources(node, sources) for node in tree[1:])
+
+
+def read_sources(tree):
+    """ Returns the top-level keys of the user data read by this parsed rule, or None when they can not be determined (like `$.*`). """
+    sources = set()
+    if not _collect_sources(tree, sources):
+        return None
+    return frozenset(sources)
+
+
+def static_path(tree, start=ROOT):
+    """ Returns the keys of a path like `$.brp.persoon.mokum`, or None when the tree is not such a path. """
+    if tree == start:
+        return ()
+    if type(tree) is tuple and len(tree) == 3 and tree[0] == '.' and type(tree[2]) is tuple and tree[2][0] == 'name':
+        parent = static_path(tree[1], start)
+        if parent is not None:
+            return parent + (tree[2][1],)
+    return None
+
+
+def _element_fields(tree, fields):
+    """ Adds the fields read from @ in a filter condition, returns False when @ is used in any other way. """
+    if type(tree) is not tuple or not tree:
+        return True
+    if tree == CURRENT:
+        return False
+    if tree[0] == '.':
+        path = static_path(tree, CURRENT)
+        if path is not None:
+            fields.add(path)
+            return True
+    if tree[0] == '[':
+        # @ in a nested filter is an element of that list
+        return _element_fields(tree[1], fields)
+    return all(_element_fields(node, fields) for node in tree[1:])
+
+
+def _add_path(paths, path, fields):
+    """ Adds a path, fields None means everything below the path matters. """
+    if fields is None or (path in paths and paths[path] is None):
+        paths[path] = None
+    else:
+        paths[path] = paths.get(path, frozenset()) | fields
+
+
+def _collect_paths(tree, paths, in_filter, counted):
+    """
+    Adds the paths the outcome of this (part of a) parse tree depends on. `counted` is True when only the number of
+    elements of the result matters, like for the rule itself (which only has to yield anything) and within len().
+    """
+    if type(tree) is not tuple or not tree:
+        return
+    path = static_path(tree)
+    if path is not None:
+        _add_path(paths, path, frozenset() if counted else None)
+    elif tree == CURRENT:
+        if not in_filter:
+            # outside of a filter @ is the whole user data
+            _add_path(paths, (), None)
+    else:
+        collect = _OPERATOR_PATHS.get(tree[0], _collect_operand_paths)
+        collect(tree, paths, in_filter, counted)
+
+
+def _collect_operand_paths(tree, paths, in_filter, counted):
+    for node in tree[1:]:
+        _collect_paths(node, paths, in_filter, False)
+
+
+def _collect_filter_paths(tree, paths, in_filter, counted):
+    if len(tree) != 3:
+        return _collect_operand_paths(tree, paths, in_filter, counted)
+    path = static_path(tree[1])
+    fields = set()
+    if counted and path is not None and type(tree[2]) is tuple and _element_fields(tree[2], fields):
+        # only the fields the filter reads of every element of the list matter
+        _add_path(paths, path, frozenset(fields))
+    else:
+        _collect_paths(tree[1], paths, in_filter, False)
+    # within the filter @ is an element of the selected list, the paths starting at $ still count
+    _collect_paths(tree[2], paths, True, False)
+
+
+def _collect_function_paths(tree, paths, in_filter, counted):
+    if tree[1] == 'len' and len(tree) == 3:
+        # only the number of elements of the argument matters
+        _collect_paths(tree[2], paths, in_filter, True)
+    else:
+        _collect_operand_paths(tree, paths, in_filter, counted)
+
+
+# the operators where the paths do not simply depend on all operands
+_OPERATOR_PATHS = {
+    '[': _collect_filter_paths,
+    'fn': _collect_function_paths,
+}
+
+
+def read_paths(tree):
+    """
+    Returns the paths (tuples of keys) into the user data a parsed rule depends on. Each path maps to the fields of
+    its elements which matter when it is a list, or None when everything below the path matters.
+    For example `len($.brp.kinderen[dateTime(@.geboortedatum) ...])` gives {('brp', 'kinderen'): {('geboortedatum',)}}
+    and `$.focus.*[...]` gives {('focus',): None}.
+    """
+    paths = {}
+    # a rule matches when its result is truthy or yields anything
+    _collect_paths(tree, paths, False, True)
+    return paths
+
+
+def merge_paths(paths, other):
+    """ Adds the paths of `other` to `paths`. """
+    for path, fields in other.items():
+        _add_path(paths, path, fields)
+
 
-def apply_rules(userdata, rules, compound_rules):
-    """ returns True when it matches the rules. """
-    return all([_apply_rule(userdata, r, compound_rules) for r in rules])
+def prune(data, paths):
+    """
+    Returns the user data with only what is at `paths`, (path, fields) pairs like the items of read_paths, so the
+    rules reading those paths have the same outcome. The elements of a list with fields only keep those fields.
+    """
+    pruned = {}
+    for path, fields in paths:
+        if not path:
+            return data
+        _prune_path(data, pruned, path, fields)
+    return pruned
 
 
-def _apply_rule(userdata, rule, compound_rules):
+def _prune_path(data, pruned, path, fields):
+    key = path[0]
+    if key not in data:
+        return
+    value = data[key]
+    if len(path) > 1 and type(value) is dict:
+        part = pruned.get(key)
+        if part is None:
+            part = pruned[key] = {}
+        if part is not value:
+            _prune_path(value, part, path[1:], fields)
+    elif key in pruned:
+        # another path reads part of it, keep all of it
+        pruned[key] = value
+    elif len(path) == 1 and fields is not None and type(value) is list:
+        element_paths = [(field, None) for field in fields]
+        pruned[key] = [prune(element, element_paths) if type(element) is dict else element for element in value]
+    else:
+        # objectpath maps the rest of the path over a list, so everything from here matters
+        pruned[key] = value
+
+
+def is_match(result):
+    """ Whether a rule result counts as a match. For generators only check whether they yield anything. """
+    if type(result) is generator:
+        for _ in result:
+            return True
+        return False
+    return bool(result)
+
+
+# all compiled rules, keyed by rule text
+compiled_rules = {}
+
+_compiler = _empty_tree = Tree({})
+# the objectpath parser keeps its state in module globals
+_compile_lock = threading.Lock()
+
+
+def _execute_constant(tree):
+    """ Executes a parsed rule which does not read the user data with objectpath. """
+    source = to_source(tree)
+    with _compile_lock:
+        _compiler.compile(source)
+    return _empty_tree.execute(source)
+
+
+class UserData:
+    """ The user data of a request, its objectpath Tree is only built when a rule needs it. """
+    __slots__ = ('data', '_tree')
+
+    def __init__(self, data):
+        self.data = data
+        self._tree = None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = Tree(self.data)
+        return self._tree
+
+
+def compile_rule(rule):
+    """ Returns the CompiledRule for this rule text, parsing it only the first time it is seen. """
+    compiled = compiled_rules.get(rule)
+    if compiled is not None:
+        return compiled
+
+    with _compile_lock:
+        try:
+            tree = _compiler.compile(rule)
+        except Exception as e:
+            raise RuleCompileError(f"Rule {rule!r} does not compile: {e!r}") from e
+
+    compiled = compiled_rules[rule] = CompiledRule(rule, tree)
+    return compiled
+
+
+def compile_rules(rules, compound_rules):
+    """ Compile all rules in this list, raises RuleCompileError for rules that do not compile or refer to unknown compound rules. """
+    for rule in rules:
+        if rule['type'] == "rule":
+            compile_rule(rule['rule'])
+        elif rule['type'] == "ref" and rule['ref_id'] not in compound_rules:
+            raise RuleCompileError(f"Rule refers to unknown compound rule {rule['ref_id']!r}")
+
+
+def required_sources(rules, compound_rules, _seen=()):
+    """ The user data sources without which these rules can not match, following compound rule refs. """
+    required = set()
+    for rule in rules:
+        if rule['type'] == "rule":
+            required |= compile_rule(rule['rule']).requires
+        elif rule['type'] == "ref" and rule['ref_id'] not in _seen:
+            ref_id = rule['ref_id']
+            required |= required_sources(compound_rules[ref_id]['rules'], compound_rules, _seen + (ref_id,))
+    return frozenset(required)
+
+
+def rule_paths(rules, compound_rules, paths=None, _seen=()):
+    """ The paths into the user data the outcome of these rules depends on (see read_paths), following compound rule refs. """
+    if paths is None:
+        paths = {}
+    for rule in rules:
+        if rule['type'] == "rule":
+            merge_paths(paths, compile_rule(rule['rule']).paths)
+        elif rule['type'] == "ref" and rule['ref_id'] not in _seen:
+            ref_id = rule['ref_id']
+            rule_paths(compound_rules[ref_id]['rules'], compound_rules, paths, _seen + (ref_id,))
+    return paths
+
+
+def rule_cost(rule, compound_rules, costs=None, _seen=()):
+    """
+    Cost of a single rule. Uses the measured cost from `costs` (keyed by rule text or ref_id) when available and
+    the estimated cost of the compiled rule otherwise.
+    """
     if rule['type'] == "rule":
+        if costs and rule['rule'] in costs:
+            return costs[rule['rule']]
+        return compile_rule(rule['rule']).cost
+
+    if rule['type'] == "ref":
+        ref_id = rule['ref_id']
+        if costs and ref_id in costs:
+            return costs[ref_id]
+        if ref_id in _seen or ref_id not in compound_rules:
+            return 0
+        return sum(rule_cost(r, compound_rules, costs, _seen + (ref_id,)) for r in compound_rules[ref_id]['rules'])
+    return 0
+
+
+def order_rules(rules, compound_rules, costs=None):
+    """
+    Returns the rules ordered from cheap to expensive. apply_rules stops at the first rule that fails, so this way
+    the expensive rules only run when all cheap ones passed. The outcome of apply_rules does not depend on the order.
+    """
+    return sorted(rules, key=lambda rule: rule_cost(rule, compound_rules, costs))
+
+
+class EvaluationContext:
+    """
+    Evaluation state for one user. Compound rule results are cached by ref_id so every compound rule is
+    evaluated at most once, no matter how many tips refer to it.
+    `evaluated` and `skipped` count the rules that were executed and the ones skipped because an earlier rule failed.
+    When `timed` the rules, compound rules and tips of this user are measured for the metrics.
+    """
+    __slots__ = ('compound_results', 'evaluating', 'evaluated', 'skipped', 'timed')
+
+    def __init__(self):
+        self.compound_results = {}
+        self.evaluating = set()
+        self.evaluated = 0
+        self.skipped = 0
+        self.timed = metrics.sampled()
+
+
+def apply_rules(userdata, rules, compound_rules, context=None):
+    """ returns True when it matches the rules. Stops at the first rule which does not match. """
+    if context is None:
+        context = EvaluationContext()
+    for index, rule in enumerate(rules):
+        if not _apply_rule(userdata, rule, compound_rules, context):
+            context.skipped += len(rules) - index - 1
+            return False
+    return True
+
+
+def apply_rules_batch(userdatas, rules, compound_rules, contexts):
+    """
+    apply_rules for many users at once, `contexts` has the EvaluationContext of every user in `userdatas`.
+    Every rule runs for all users who passed the rules before it, so each expression is executed back to back.
+    Returns the indexes of the users who match all rules.
+    """
+    remaining = range(len(userdatas))
+    for index, rule in enumerate(rules):
+        passed = []
+        for user in remaining:
+            if _apply_rule(userdatas[user], rule, compound_rules, contexts[user]):
+                passed.append(user)
+            else:
+                contexts[user].skipped += len(rules) - index - 1
+        remaining = passed
+        if not remaining:
+            break
+    return list(remaining)
+
+
+def _apply_compound_rule(userdata, ref_id, compound_rules, context):
+    result = context.compound_results.get(ref_id)
+    if result is not None:
+        return result
+
+    if ref_id in context.evaluating:
+        raise CompoundRuleCycleError(f"Compound rule {ref_id!r} refers to itself")
+
+    compound_rule = compound_rules[ref_id]
+    context.evaluating.add(ref_id)
+    start = metrics.clock() if context.timed else None
+    try:
+        result = bool(apply_rules(userdata, compound_rule['rules'], compound_rules, context))
+    finally:
+        context.evaluating.discard(ref_id)
+    if start is not None:
+        metrics.observe(metrics.COMPOUND_RULE, ref_id, metrics.clock() - start, result)
+
+    context.compound_results[ref_id] = result
+    return result
+
+
+def _apply_rule(userdata, rule, compound_rules, context):
+    if rule['type'] == "rule":
+        compiled = compile_rule(rule['rule'])
+        context.evaluated += 1
+        if context.timed:
+            return _timed_rule(compiled, userdata)
         try:
-            result = userdata.execute(rule['rule'])
-            if type(result) == generator:
-                return list(result)
-            return result
+            return compiled.matches(userdata)
         except ExecutionError:
             return False
 
     if rule['type'] == "ref":
-        compound_rule = compound_rules[rule['ref_id']]
-        return apply_rules(userdata, compound_rule['rules'], compound_rules)
+        return _apply_compound_rule(userdata, rule['ref_id'], compound_rules, context)
     return False
+
+
+def _timed_rule(compiled, userdata):
+    start = metrics.clock()
+    try:
+        result = compiled.matches(userdata)
+    except ExecutionError:
+        metrics.observe(metrics.RULE, compiled.source, metrics.clock() - start, False, error=True)
+        return False
+    metrics.observe(metrics.RULE, compiled.source, metrics.clock() - start, result)
+    return result
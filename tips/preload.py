@@ -0,0 +1,94 @@
+"""
+Preloading of the application for uWSGI. Without lazy-apps uWSGI imports the application in the master process and
+forks the workers from it, so the content (the compiled rules, the indexes and the encoded responses) is prepared once
+and the workers share its memory copy-on-write. When TIPS_PRELOAD_FREEZE is 1 (the default) the garbage collector is
+off while the application is imported and gc.freeze() moves everything it created out of its reach before the fork,
+so collections in the workers do not write to the shared pages. Each worker turns it back on when it starts.
+
+Every worker logs the time the preload took and its memory when it starts, /status/memory has the current numbers.
+"""
+import gc
+import importlib
+import logging
+import os
+import time
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:  # pragma: no cover
+    postfork = None
+
+from tips.config import get_preload_freeze
+
+logger = logging.getLogger(__name__)
+
+PRELOAD_FREEZE = get_preload_freeze()
+
+# the process which imported the application, how long that took and how many objects were frozen
+startup = {}
+
+# the fields of /proc/self/smaps_rollup in the report, in KiB
+_MEMORY_FIELDS = {
+    'Rss': 'rss_kib',
+    'Pss': 'pss_kib',
+    'Shared_Clean': 'shared_kib',
+    'Shared_Dirty': 'shared_kib',
+    'Private_Clean': 'private_kib',
+    'Private_Dirty': 'private_kib',
+}
+
+
+def load(module, name='application'):
+    """ Imports the application from `module`, with everything it prepares at import, and returns it. """
+    started = time.monotonic()
+    if PRELOAD_FREEZE:
+        gc.disable()
+    application = getattr(importlib.import_module(module), name)
+
+    frozen = 0
+    if PRELOAD_FREEZE:
+        gc.freeze()
+        frozen = gc.get_freeze_count()
+        if postfork is None:
+            # no workers will be forked from this process
+            gc.enable()
+    startup.update(pid=os.getpid(), seconds=round(time.monotonic() - started, 3), frozen_objects=frozen)
+    return application
+
+
+def memory():
+    """ The memory of this process in KiB, from /proc/self/smaps_rollup. Empty when that is not available. """
+    try:
+        with open('/proc/self/smaps_rollup') as fp:
+            lines = fp.readlines()
+    except OSError:
+        return {}
+
+    usage = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(':')
+        field = _MEMORY_FIELDS.get(key)
+        if field is not None:
+            usage[field] = usage.get(field, 0) + int(value.split()[0])
+    return usage
+
+
+def report():
+    """ The startup time and memory of this process, and whether it was forked from the one which loaded the application. """
+    return {
+        "pid": os.getpid(),
+        "preloaded": startup.get('pid') not in (None, os.getpid()),
+        "startup_seconds": startup.get('seconds'),
+        "frozen_objects": startup.get('frozen_objects', 0),
+        **memory(),
+    }
+
+
+def _worker_started():
+    if PRELOAD_FREEZE:
+        gc.enable()
+    logger.warning("Worker started: %s", ', '.join(f"{key}={value}" for (key, value) in report().items()))
+
+
+if postfork is not None:  # pragma: no cover
+    postfork(_worker_started)
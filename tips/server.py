@@ -1,16 +1,19 @@
 import connexion
 import sentry_sdk
-import os
-import json
 
-from tips.config import PROJECT_PATH
-from flask import request, send_from_directory
+from flask import Request, Response, abort, jsonify, request
 from sentry_sdk.integrations.flask import FlaskIntegration
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.utils import cached_property
 
-from tips.api.tip_generator import tips_generator
-from tips.config import get_sentry_dsn, get_photo_path
-
-PERSOONLIJK_INKOMENS_TIPS_FILE = os.path.join(PROJECT_PATH, 'api', 'persoonlijk_inkomens_tips.json')
+from tips.api.images import find_image, image_response
+from tips.api import json_backend
+from tips.api.json_backend import decode_body, LimitExceeded
+from tips.api.tip_generator import tips_generator, tips_generator_batch, encode_response, encode_responses, \
+    get_snapshot, INCOME_TIPS_POOL
+from tips import preload
+from tips.config import get_sentry_dsn
+from tips.generator import metrics
 
 
 app = connexion.FlaskApp(__name__, specification_dir='openapi/')
@@ -23,26 +26,83 @@ if get_sentry_dsn():  # pragma: no cover
     )
 
 
+BATCH_PATH = '/tips/gettips/batch'
+
+
+class JSONRequest(Request):
+    """
+    A request which decodes its JSON body once, with the JSON backend and its limits. Connexion decodes the body of every
+    JSON operation before the handler runs, so the limits apply here, before the body is read or parsed.
+    """
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if not (force or self.is_json):
+            return None
+        value, error = self._decoded_json
+        if error is not None and not silent:
+            raise error
+        return value
+
+    @cached_property
+    def _decoded_json(self):
+        """ The decoded body and None, or None and the error for it. Decoded once, for connexion and the handler. """
+        max_bytes = json_backend.MAX_BATCH_BODY_BYTES if self.path == BATCH_PATH else json_backend.MAX_BODY_BYTES
+        if self.content_length is not None and self.content_length > max_bytes:
+            return None, RequestEntityTooLarge(f"The body is larger than {max_bytes} bytes")
+        try:
+            return decode_body(self.get_data(), max_bytes), None
+        except LimitExceeded as e:
+            return None, RequestEntityTooLarge(str(e))
+        except ValueError:
+            return None, BadRequest("The body is not valid JSON")
+
+
+app.app.request_class = JSONRequest
+
+
+def read_json():
+    """
+    The JSON body of the request, decoded with the JSON backend. A body larger than the limit of the endpoint is
+    rejected before it is read when it says its length, the decoded JSON can not nest deeper or have longer arrays
+    than configured.
+    """
+    return request.get_json(force=True)
+
+
+def json_response(body):
+    return Response(body, mimetype='application/json')
+
+
 # Route is defined in swagger/tips.yaml
 def get_tips():
     # This is a POST because the user data gets sent in the body.
     # This data is too large and inappropriate for a GET, also because of privacy reasons
-    tips_data = tips_generator(request.get_json())
-    return tips_data
+    tips_data = tips_generator(read_json())
+    return json_response(encode_response(tips_data))
 
 
 def get_income_tips():
     # This is a POST because the user data gets sent in the body.
     # This data is too large and inappropriate for a GET, also because of privacy reasons
-    with open(PERSOONLIJK_INKOMENS_TIPS_FILE) as fp:
-        persoonlijk_inkomens_tips = json.load(fp)
-    tips_data = tips_generator(request.get_json(), persoonlijk_inkomens_tips)
-    return tips_data
+    tips_data = tips_generator(read_json(), pool=INCOME_TIPS_POOL)
+    return json_response(encode_response(tips_data))
+
+
+def get_tips_batch():
+    # The body is a list of user data, the response has the tips for each of them in the same order
+    user_datas = read_json()
+    if type(user_datas) is not list or not all(type(user_data) is dict for user_data in user_datas):
+        raise BadRequest("The body is not an array of user data")
+    tips_data = tips_generator_batch(user_datas)
+    return json_response(encode_responses(tips_data))
 
 
 @app.route('/tips/static/tip_images/<path:filename>')
 def download_file(filename):
-    return send_from_directory(get_photo_path(), filename, as_attachment=True)
+    image = find_image(filename)
+    if image is None:
+        abort(404)
+    return image_response(image, filename, request)
 
 
 @app.route('/status/health')
@@ -50,6 +110,24 @@ def health_check():
     return 'OK'
 
 
+@app.route('/status/cache')
+def cache_status():
+    cache = get_snapshot().result_cache
+    if cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **cache.stats()})
+
+
+@app.route('/status/metrics')
+def metrics_status():
+    return Response(metrics.prometheus(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/status/memory')
+def memory_status():
+    return jsonify(preload.report())
+
+
 app.add_api('tips.yaml')
 
 # set the WSGI application callable to allow using uWSGI:
@@ -1,8 +1,11 @@
 import os
+import tempfile
+from unittest.mock import patch
 
 from flask_testing import TestCase
 
-from tips.api.tip_generator import tips_pool
+from tips.api import images, json_backend
+from tips.api.tip_generator import get_snapshot
 from tips.config import PROJECT_PATH
 from tips.server import application
 from tips.tests.fixtures.fixture import get_fixture
@@ -32,6 +35,59 @@ class ApiTests(TestCase):
         
         self.assertEqual(tips[0]['reason'], ["Afgelopen 3 maanden verhuisd"])
 
+    def test_tips_batch(self):
+        user_datas = [self._get_client_data(), get_fixture(optin=False)]
+        response = self.client.post('/tips/gettips/batch', json=user_datas)
+        self.assert200(response)
+
+        data = response.get_json()
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[0], self.client.post('/tips/gettips', json=user_datas[0]).get_json())
+        self.assertEqual(data[1], self.client.post('/tips/gettips', json=user_datas[1]).get_json())
+
+        response = self.client.post('/tips/gettips/batch', json={"optin": True})
+        self.assert400(response)
+
+    def test_tips_invalid_json(self):
+        response = self.client.post('/tips/gettips', data=b'{"optin": ', content_type='application/json')
+        self.assert400(response)
+
+    def test_tips_limits(self):
+        with patch.object(json_backend, 'MAX_BODY_BYTES', 100):
+            response = self.client.post('/tips/gettips', json=self._get_client_data())
+            self.assertEqual(response.status_code, 413)
+
+        user_data = get_fixture(optin=False)
+        user_data['data']['nested'] = [[[[[[[[[[]]]]]]]]]]
+        with patch.object(json_backend, 'MAX_JSON_DEPTH', 8):
+            response = self.client.post('/tips/gettips', json=user_data)
+            self.assertEqual(response.status_code, 413)
+
+        user_data['data']['nested'] = list(range(100))
+        with patch.object(json_backend, 'MAX_ARRAY_LENGTH', 50):
+            response = self.client.post('/tips/gettips', json=user_data)
+            self.assertEqual(response.status_code, 413)
+        self.assert200(self.client.post('/tips/gettips', json=user_data))
+
+    def test_tips_batch_limits(self):
+        user_datas = [get_fixture(optin=False)]
+        with patch.object(json_backend, 'loads', wraps=json_backend.loads) as loads:
+            with patch.object(json_backend, 'MAX_BATCH_BODY_BYTES', 100):
+                response = self.client.post('/tips/gettips/batch', json=user_datas)
+                self.assertEqual(response.status_code, 413)
+            # rejected before it is parsed
+            loads.assert_not_called()
+
+            user_datas[0]['data']['nested'] = [[[[[[[[[[]]]]]]]]]]
+            with patch.object(json_backend, 'MAX_JSON_DEPTH', 8):
+                response = self.client.post('/tips/gettips/batch', json=user_datas)
+                self.assertEqual(response.status_code, 413)
+
+            loads.reset_mock()
+            self.assert200(self.client.post('/tips/gettips/batch', json=user_datas))
+            # decoded once, for connexion and the handler
+            loads.assert_called_once()
+
     def test_income_tips(self):
         response = self.client.post('/tips/getincometips', json=self._get_client_data())
 
@@ -40,7 +96,7 @@ class ApiTests(TestCase):
         self.assertEqual(24, len(tips))
         
     def test_images(self):
-        for tip in tips_pool:
+        for tip in get_snapshot().tips_pool:
             url = tip['imgUrl']
             url = url.lstrip('/api')  # api is from the load balancer, not this api
             response = self.client.get(url)
@@ -69,3 +125,64 @@ class ApiStaticFiles(TestCase):
             response = self.client.get('/tips/static/tip_images/../../config.py')
             self.assert404(response)
             self.assertNotEqual(response.data, fh.read())
+
+    def test_cache_headers(self):
+        response = self.client.get('/tips/static/tip_images/afvalpunt.jpg')
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], images.CACHE_CONTROL)
+
+        response = self.client.get('/tips/static/tip_images/afvalpunt.jpg', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        response = self.client.get('/tips/static/tip_images/afvalpunt.jpg', headers={'If-None-Match': '"other"'})
+        self.assert200(response)
+
+    def test_hashed_url(self):
+        image = images.find_image('afvalpunt.jpg')
+        url = images.hashed_url('/api/tips/static/tip_images/afvalpunt.jpg')
+        self.assertEqual(url, f'/api/tips/static/tip_images/{image.hashed_name}')
+        self.assertEqual(images.hashed_url('/elsewhere/afvalpunt.jpg'), '/elsewhere/afvalpunt.jpg')
+        self.assertEqual(images.hashed_url('/api/tips/static/tip_images/nope.jpg'), '/api/tips/static/tip_images/nope.jpg')
+
+        response = self.client.get(url[len('/api'):])
+        self.assert200(response)
+        self.assertEqual(response.headers['Cache-Control'], images.IMMUTABLE_CACHE_CONTROL)
+        self.assertEqual(response.headers['ETag'], f'"{image.etag}"')
+        with open(image.path, 'rb') as img:
+            self.assertEqual(response.data, img.read())
+
+        # the tips refer to the hashed names
+        records = get_snapshot().indexes['tips'].entries
+        self.assertTrue(all(images.find_image(record.record['imgUrl'].rpartition('/')[2]) for record in records))
+        self.assertIn(image.hashed_name, [record.record['imgUrl'].rpartition('/')[2] for record in records])
+
+    def test_added_image(self):
+        with tempfile.TemporaryDirectory() as directory, patch.object(images, '_directory', directory):
+            with open(os.path.join(directory, 'nieuw.jpg'), 'wb') as fp:
+                fp.write(b'first')
+            response = self.client.get('/tips/static/tip_images/nieuw.jpg')
+            self.assert200(response)
+            self.assertEqual(response.headers['Cache-Control'], images.CACHE_CONTROL)
+            etag = response.headers['ETag']
+
+            with open(os.path.join(directory, 'nieuw.jpg'), 'wb') as fp:
+                fp.write(b'second')
+            response = self.client.get('/tips/static/tip_images/nieuw.jpg', headers={'If-None-Match': etag})
+            self.assert200(response)
+            self.assertEqual(response.data, b'second')
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+            # its hashed name is not immutable, it was not there at the start
+            image = images.find_image('nieuw.jpg')
+            self.assertEqual(dict(images.image_headers(image, image.hashed_name))['Cache-Control'], images.CACHE_CONTROL)
+            self.assert404(self.client.get(f'/tips/static/tip_images/{image.hashed_name}'))
+
+    def test_sendfile(self):
+        with patch.object(images, 'IMAGE_SENDFILE', 'x-accel-redirect'):
+            response = self.client.get('/tips/static/tip_images/afvalpunt.jpg')
+            self.assertEqual(response.headers['X-Accel-Redirect'], images.IMAGE_ACCEL_PREFIX + 'afvalpunt.jpg')
+            self.assertEqual(response.data, b'')
+        with patch.object(images, 'IMAGE_SENDFILE', 'x-sendfile'):
+            response = self.client.get('/tips/static/tip_images/afvalpunt.jpg')
+            self.assertEqual(response.headers['X-Sendfile'], images.find_image('afvalpunt.jpg').path)
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+
+from werkzeug.datastructures import Headers
+
+from tips import asgi
+from tips.api import images
+from tips.server import application as wsgi_application
+from tips.tests.fixtures.fixture import get_fixture
+
+
+def call(method, path, body=b'', headers=(), chunk_size=None):
+    """ Calls the ASGI application, returns the status, the headers and the body of the response. """
+    if body:
+        headers = [('Content-Type', 'application/json'), *headers]
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] if chunk_size and body else [body]
+    messages = [
+        {'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+        for (i, chunk) in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': method,
+        'path': path,
+        'root_path': '',
+        'query_string': b'',
+        'headers': [(key.lower().encode(), value.encode()) for (key, value) in headers],
+    }
+    asyncio.run(asgi.application(scope, receive, send))
+    headers = Headers([(key.decode(), value.decode()) for (key, value) in sent[0]['headers']])
+    return sent[0]['status'], headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+
+class AsgiTest(TestCase):
+    def test_health(self):
+        self.assertEqual(call('GET', '/status/health')[::2], (200, b'OK'))
+        self.assertEqual(call('POST', '/status/health')[0], 405)
+        self.assertEqual(call('GET', '/nope')[0], 404)
+        status, headers, _ = call('GET', '/status/metrics')
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        status, _, body = call('GET', '/status/memory')
+        self.assertEqual(status, 200)
+        self.assertIn(b'"preloaded"', body)
+
+    def test_tips(self):
+        client = wsgi_application.test_client()
+        for optin in (True, False):
+            user_data = get_fixture(optin=optin)
+            body = json.dumps(user_data).encode()
+            for path in ('/tips/gettips', '/tips/getincometips'):
+                status, headers, data = call('POST', path, body, [('Transfer-Encoding', 'chunked')], chunk_size=1000)
+                self.assertEqual(status, 200)
+                self.assertEqual(headers['Content-Type'], 'application/json')
+                self.assertEqual(json.loads(data), client.post(path, json=user_data).get_json())
+
+        status, _, data = call('POST', '/tips/gettips/batch', json.dumps([get_fixture(optin=False)]).encode())
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(data)), 1)
+
+    def test_invalid(self):
+        self.assertEqual(call('POST', '/tips/gettips', b'{"optin": ')[0], 400)
+        self.assertEqual(call('POST', '/tips/gettips/batch', b'{"optin": true}')[0], 400)
+        self.assertEqual(call('GET', '/tips/gettips')[0], 405)
+
+        body = json.dumps(get_fixture(optin=False)).encode()
+        with patch.object(asgi.json_backend, 'MAX_BODY_BYTES', 100):
+            self.assertEqual(call('POST', '/tips/gettips', body, chunk_size=50)[0], 413)
+            self.assertEqual(call('POST', '/tips/gettips', body, [('Content-Length', str(len(body)))])[0], 413)
+
+    def test_queue(self):
+        with patch.object(asgi, '_pending', asgi.ASGI_WORKERS + asgi.ASGI_QUEUE):
+            self.assertEqual(call('POST', '/tips/gettips', json.dumps(get_fixture(optin=False)).encode())[0], 503)
+            # these do not wait for the rules
+            self.assertEqual(call('GET', '/status/health')[0], 200)
+            self.assertEqual(call('GET', '/tips/static/tip_images/afvalpunt.jpg')[0], 200)
+
+    def test_pending_after_body(self):
+        read_body = asgi._read_body
+        pending = []
+
+        async def counting_read_body(*args):
+            pending.append(asgi._pending)
+            return await read_body(*args)
+
+        body = json.dumps(get_fixture(optin=False)).encode()
+        with patch.object(asgi, '_read_body', counting_read_body):
+            self.assertEqual(call('POST', '/tips/gettips', body, chunk_size=1000)[0], 200)
+        # the request did not count while its body was received
+        self.assertEqual(pending, [0])
+        self.assertEqual(asgi._pending, 0)
+
+    def test_lifespan(self):
+        executor = ThreadPoolExecutor(1)
+        release = threading.Event()
+        executor.submit(release.wait)
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+        released_by = []
+
+        async def receive():
+            return messages.pop(0)
+
+        def release_from(who):
+            released_by.append(who)
+            release.set()
+
+        async def send(message):
+            sent.append(message['type'])
+            if message['type'] == 'lifespan.startup.complete':
+                asyncio.get_running_loop().call_later(0.05, release_from, 'loop')
+
+        timer = threading.Timer(5, release_from, ['timer'])
+        timer.start()
+        with patch.object(asgi._rules, 'executor', executor):
+            asyncio.run(asgi.application({'type': 'lifespan'}, receive, send))
+        timer.cancel()
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        # the event loop kept running while the shutdown waited for the running rules
+        self.assertEqual(released_by[0], 'loop')
+
+    def test_scope_types(self):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(asgi.application({'type': 'websocket', 'path': '/status/health'}, None, send))
+        self.assertEqual(sent, [{'type': 'websocket.close'}])
+        with self.assertRaises(ValueError):
+            asyncio.run(asgi.application({'type': 'other'}, None, send))
+
+    def test_head(self):
+        client = wsgi_application.test_client()
+        for path in ('/status/health', '/status/cache', '/tips/static/tip_images/afvalpunt.jpg'):
+            status, headers, data = call('HEAD', path)
+            response = client.head(path)
+            self.assertEqual((status, data), (response.status_code, b''), path)
+            self.assertEqual(headers['Content-Type'], response.headers['Content-Type'], path)
+            # the length of the body a GET gets
+            self.assertEqual(int(headers['Content-Length']), len(call('GET', path)[2]), path)
+        for path in ('/tips/gettips', '/nope', '/tips/static/tip_images/nope.jpg'):
+            status, _, data = call('HEAD', path)
+            self.assertEqual((status, data), (client.head(path).status_code, b''), path)
+
+    def test_images(self):
+        image = images.find_image('afvalpunt.jpg')
+        status, headers, data = call('GET', '/tips/static/tip_images/' + image.hashed_name)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Cache-Control'], images.IMMUTABLE_CACHE_CONTROL)
+        with open(image.path, 'rb') as img:
+            self.assertEqual(data, img.read())
+
+        status, _, data = call('GET', '/tips/static/tip_images/afvalpunt.jpg', headers=[('If-None-Match', headers['ETag'])])
+        self.assertEqual((status, data), (304, b''))
+        self.assertEqual(call('GET', '/tips/static/tip_images/../../config.py')[0], 404)
@@ -0,0 +1,29 @@
+import random
+from unittest import TestCase
+
+from tips.benchmark import generate_user_data, measure, compare, SIZES
+
+
+class BenchmarkTest(TestCase):
+    def test_generate_user_data(self):
+        user_data = generate_user_data(random.Random(1), 'large')
+        data = user_data['data']
+
+        self.assertTrue(user_data['optin'])
+        self.assertEqual(len(data['focus']), SIZES['large']['focus'])
+        self.assertEqual(len(data['wmo']), SIZES['large']['wmo'])
+        self.assertEqual(len(data['belasting']['tips']), SIZES['large']['belasting'])
+        self.assertLessEqual(len(data['brp']['kinderen']), SIZES['large']['kinderen'])
+
+        # the same seed gives the same data
+        self.assertEqual(generate_user_data(random.Random(1), 'large'), user_data)
+
+    def test_measure(self):
+        result = measure(lambda payload: [payload] * 100, [1, 2], 3)
+        self.assertEqual(sorted(result), ['mean_us', 'p50_us', 'p95_us', 'p99_us', 'peak_alloc_kib'])
+        self.assertLessEqual(result['p50_us'], result['p99_us'])
+
+    def test_compare(self):
+        baseline = {'a': {'p50_us': 10}, 'b': {'p50_us': 10}}
+        results = {'a': {'p50_us': 11}, 'b': {'p50_us': 20}, 'c': {'p50_us': 1}}
+        self.assertEqual(compare(results, baseline, 1.2), ['b'])
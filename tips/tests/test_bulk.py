@@ -0,0 +1,55 @@
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from tips.api.tip_generator import tips_generator
+from tips.bulk import read_chunks, generate, main
+from tips.tests.fixtures.fixture import get_fixture
+
+
+class BulkTest(TestCase):
+    def get_lines(self):
+        user_datas = [get_fixture(optin=True), get_fixture(optin=False), get_fixture(optin=True)]
+        return user_datas, [json.dumps(user_data) + '\n' for user_data in user_datas]
+
+    def test_read_chunks(self):
+        self.assertEqual(list(read_chunks(['a', '', 'b', '\n', 'c'], 2)), [['a', 'b'], ['c']])
+        self.assertEqual(list(read_chunks([], 2)), [])
+
+    def check_generate(self, workers):
+        user_datas, lines = self.get_lines()
+        output = io.StringIO()
+        summary = io.StringIO()
+        matches = generate(iter(lines), output, workers=workers, chunk_size=2, summary=summary)
+
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        expected = [json.loads(json.dumps(tips_generator(user_data))) for user_data in user_datas]
+        # every line of the output is a result
+        self.assertEqual(records, expected)
+
+        counts = {}
+        for record in records:
+            for tip in record['items']:
+                counts[tip['id']] = counts.get(tip['id'], 0) + 1
+        self.assertEqual(json.loads(summary.getvalue()), {"users": 3, "matches": counts})
+        self.assertEqual(dict(matches), counts)
+
+    def test_generate(self):
+        self.check_generate(1)
+
+    def test_generate_workers(self):
+        self.check_generate(2)
+
+    def test_main(self):
+        _, lines = self.get_lines()
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, name) for name in ('users.ndjson', 'tips.ndjson', 'summary.json')]
+            with open(paths[0], 'w') as fp:
+                fp.writelines(lines)
+            self.assertEqual(main([paths[0], '--output', paths[1], '--summary', paths[2]]), 0)
+            with open(paths[1]) as fp:
+                self.assertEqual(len(fp.read().splitlines()), 3)
+            with open(paths[2]) as fp:
+                self.assertEqual(json.load(fp)['users'], 3)
@@ -0,0 +1,92 @@
+import random
+from unittest import TestCase, skipIf
+
+from objectpath import Tree
+
+from tips.api.tip_generator import get_snapshot, tip_filter
+from tips.benchmark import generate_user_data
+from tips.generator.columnar import np, match_bitmaps, to_source, Table, ColumnarEvaluator
+from tips.generator.rule_engine import apply_rules, compile_rule, compiled_rules, CompoundRuleCycleError
+
+
+def new_rule(rule: str):
+    return {
+        "type": "rule",
+        "rule": rule
+    }
+
+
+@skipIf(np is None, "numpy is not installed")
+class ColumnarTest(TestCase):
+    def get_datas(self, count=100):
+        rnd = random.Random(1)
+        datas = [generate_user_data(rnd, 'realistic')['data'] for _ in range(count)]
+
+        # values the columns can not hold, these fall back to the rule engine
+        datas[0]['brp']['persoon']['geboortedatum'] = '2000-05-05T10:00:00+02:00'
+        datas[1]['brp']['kinderen'] = [{'geboortedatum': '2015-01-01'}, {'geboortedatum': None}, {}]
+        datas[2]['brp']['persoon']['mokum'] = 1
+        datas[3]['brp']['persoon']['nationaliteiten'] = {'omschrijving': 'Nederlandse'}
+        datas[4]['brp']['adres']['begindatumVerblijf'] = '2300-01-01T00:00:00Z'
+        return datas
+
+    def test_to_source(self):
+        get_snapshot()
+        written = 0
+        for source, compiled in list(compiled_rules.items()):
+            try:
+                written_source = to_source(compiled.tree)
+            except ValueError:
+                continue
+            self.assertEqual(compile_rule(written_source).tree, compiled.tree, source)
+            written += 1
+        self.assertGreater(written, 10)
+
+        with self.assertRaises(ValueError):
+            to_source(('..', ('(root)', 'rs'), ('name', 'a')))
+        with self.assertRaises(ValueError):
+            to_source("it's")
+
+    def test_match_bitmaps(self):
+        snapshot = get_snapshot()
+        datas = self.get_datas()
+        tips = snapshot.tips_pool + snapshot.income_tips_pool
+        bitmaps = match_bitmaps(datas, tips, snapshot.compound_rules)
+
+        for tip in tips:
+            expected = [bool(tip_filter(tip, Tree(data), snapshot.compound_rules)) for data in datas]
+            self.assertEqual(bitmaps['tips'][tip['id']].tolist(), expected, tip['id'])
+
+        for ref_id in snapshot.compound_rules:
+            rules = [{"type": "ref", "ref_id": ref_id}]
+            expected = [apply_rules(Tree(data), rules, snapshot.compound_rules) for data in datas]
+            self.assertEqual(bitmaps['compound_rules'][ref_id].tolist(), expected, ref_id)
+
+    def test_vectorized(self):
+        table = Table(self.get_datas())
+        rules = [
+            "$.brp.persoon.mokum is true",
+            "dateTime($.brp.persoon.geboortedatum) + timeDelta(18, 0, 0, 0, 0, 0) <= now()",
+            "len($.brp.kinderen[now() - timeDelta(18, 0, 0, 0, 0, 0) <= dateTime(@.geboortedatum)]) >= 1",
+            "$.brp.persoon.nationaliteiten[@.omschrijving is Nederlandse]",
+        ]
+        for rule in rules:
+            _, known = table.outcome(compile_rule(rule))
+            # only the odd rows are left to the rule engine
+            self.assertGreaterEqual(known[5:].sum(), table.size - 5, rule)
+
+    def test_fallback(self):
+        datas = [{'a': 1, 'b': 2}, {'a': 2, 'b': 2}, {'a': 3}]
+        evaluator = ColumnarEvaluator(Table(datas), {})
+        rules = [new_rule("$.a + $.b > 3")]
+
+        self.assertEqual(evaluator.apply_rules(rules).tolist(), [False, True, False])
+
+    def test_compound_rule_cycle(self):
+        compound_rules = {
+            "1": {"rules": [{"type": "ref", "ref_id": "2"}]},
+            "2": {"rules": [{"type": "ref", "ref_id": "1"}]},
+        }
+        evaluator = ColumnarEvaluator(Table([{}]), compound_rules)
+        with self.assertRaises(CompoundRuleCycleError):
+            evaluator.apply_compound_rule("1")
@@ -0,0 +1,34 @@
+import json
+from unittest import TestCase, skipIf
+
+from tips.api import json_backend
+from tips.api.json_backend import check_limits, json_dumps, json_loads, orjson, LimitExceeded
+from tips.api.tip_generator import FrozenDict
+
+
+class JsonBackendTest(TestCase):
+    value = {"items": (FrozenDict({"id": "mijn-1", "title": "Één tip"}),), "total": 1, "none": None}
+
+    def test_json(self):
+        encoded = json_dumps(self.value)
+        self.assertEqual(encoded, '{"items":[{"id":"mijn-1","title":"Één tip"}],"total":1,"none":null}'.encode())
+        self.assertEqual(json_loads(encoded), json.loads(json.dumps(self.value)))
+        with self.assertRaises(ValueError):
+            json_loads(b'{')
+
+    @skipIf(orjson is None, "orjson is not installed")
+    def test_orjson(self):
+        self.assertEqual(orjson.dumps(self.value), json_dumps(self.value))
+        self.assertEqual(orjson.loads(json_dumps(self.value)), json_loads(json_dumps(self.value)))
+        with self.assertRaises(ValueError):
+            orjson.loads(b'{')
+
+    def test_backend(self):
+        self.assertEqual(json_backend.loads(json_backend.dumps(self.value)), json_loads(json_dumps(self.value)))
+
+    def test_check_limits(self):
+        check_limits({"a": [[1, 2], {"b": [3]}]}, 4, 2)
+        with self.assertRaises(LimitExceeded):
+            check_limits({"a": [[1, 2], {"b": [3]}]}, 3, 2)
+        with self.assertRaises(LimitExceeded):
+            check_limits({"a": [[1, 2, 3]]}, 4, 2)
@@ -0,0 +1,85 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from tips.api.tip_generator import match_tips, match_tips_batch, tip_filter, SourceIndex
+from tips.generator import metrics
+from tips.generator.rule_engine import apply_rules, EvaluationContext, UserData
+from tips.server import application
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_disabled(self):
+        with patch.object(metrics, 'SAMPLE_RATE', 0):
+            context = EvaluationContext()
+            self.assertFalse(context.timed)
+            self.assertTrue(apply_rules(UserData({"a": 1}), [{"type": "rule", "rule": "$.a is 1"}], {}, context))
+        self.assertEqual(metrics.get_stats(), {})
+
+    def test_sampled(self):
+        compound_rules = {
+            "1": {"name": "a is 1", "rules": [{"type": "rule", "rule": "$.a is 1"}]},
+        }
+        tip = {
+            "id": "tip-1",
+            "active": True,
+            "rules": [{"type": "ref", "ref_id": "1"}, {"type": "rule", "rule": "keys($.a)"}],
+        }
+        with patch.object(metrics, 'SAMPLE_RATE', 1):
+            for data in ({"a": 1}, {"a": 2}):
+                self.assertFalse(tip_filter(tip, UserData(data), compound_rules, EvaluationContext()))
+
+        stats = metrics.get_stats()
+        self.assertEqual(set(stats), {
+            (metrics.RULE, "$.a is 1"), (metrics.RULE, "keys($.a)"), (metrics.COMPOUND_RULE, "1"), (metrics.TIP, "tip-1")
+        })
+        rule = stats[(metrics.RULE, "$.a is 1")]
+        self.assertEqual((rule.evaluations, rule.matches, rule.errors), (2, 1, 0))
+        self.assertLessEqual(rule.max_seconds, rule.seconds)
+        # the second rule only runs when the compound rule matched, and raises an ExecutionError
+        failing = stats[(metrics.RULE, "keys($.a)")]
+        self.assertEqual((failing.evaluations, failing.matches, failing.errors), (1, 0, 1))
+        self.assertEqual(stats[(metrics.COMPOUND_RULE, "1")].matches, 1)
+        self.assertEqual(stats[(metrics.TIP, "tip-1")].evaluations, 2)
+
+    def test_rule_counts(self):
+        tip = {
+            "id": "tip-1",
+            "active": True,
+            "title": "Tip",
+            "priority": 10,
+            "rules": [{"type": "rule", "rule": "$.a is 1"}, {"type": "rule", "rule": "true"}, {"type": "rule", "rule": "true"}],
+        }
+        index = SourceIndex([tip], {}, {})
+        match_tips({"optin": True, "data": {"a": 1}}, index, {})
+        self.assertEqual(metrics.get_rule_counts(), {"evaluated": 3, "skipped": 0})
+        # the other rules are skipped when the first one fails
+        match_tips({"optin": True, "data": {"a": 2}}, index, {})
+        self.assertEqual(metrics.get_rule_counts(), {"evaluated": 4, "skipped": 2})
+        match_tips_batch([{"optin": True, "data": {"a": 2}}, {"optin": False, "data": {"a": 2}}], index, {})
+        self.assertEqual(metrics.get_rule_counts(), {"evaluated": 5, "skipped": 4})
+
+        text = metrics.prometheus()
+        self.assertIn('tips_rules_evaluated_total 5\n', text)
+        self.assertIn('tips_rules_skipped_total 4\n', text)
+
+    def test_prometheus(self):
+        metrics.observe(metrics.RULE, '$.a is "b\\c"', 0.5, True)
+        metrics.observe(metrics.RULE, '$.a is "b\\c"', 0.25, False, error=True)
+        text = metrics.prometheus()
+        self.assertIn('# TYPE tips_evaluations_total counter\n', text)
+        self.assertIn('tips_evaluations_total{type="rule",id="$.a is \\"b\\\\c\\""} 2\n', text)
+        self.assertIn('tips_evaluation_seconds_total{type="rule",id="$.a is \\"b\\\\c\\""} 0.75\n', text)
+        self.assertIn('tips_evaluation_seconds_max{type="rule",id="$.a is \\"b\\\\c\\""} 0.5\n', text)
+        self.assertIn('tips_matches_total{type="rule",id="$.a is \\"b\\\\c\\""} 1\n', text)
+        self.assertIn('tips_execution_errors_total{type="rule",id="$.a is \\"b\\\\c\\""} 1\n', text)
+
+        response = application.test_client().get('/status/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertEqual(response.get_data(as_text=True), text)
@@ -0,0 +1,122 @@
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+from objectpath import Tree
+from objectpath.core import ITER_TYPES
+
+from tips.api.tip_generator import get_snapshot
+from tips.generator import clock, native
+from tips.generator.rule_engine import compile_rule, compiled_rules, _execute_constant
+from tips.tests.fixtures.fixture import get_fixture
+
+
+def outcome(execute, data):
+    """ The result of a rule with the generators as lists, or the type of the exception it raises. """
+    try:
+        result = execute(data)
+        return list(result) if type(result) in ITER_TYPES else result
+    except Exception as e:
+        return type(e)
+
+
+def at(moment):
+    """ Runs the rules as if it is `moment`. """
+    return patch.object(clock, 'OFFSET', moment - datetime.now(timezone.utc))
+
+
+class NativeTest(TestCase):
+    data = {
+        'a': 1,
+        'b': 2.5,
+        's': 'x',
+        'z': 0,
+        'l': [1, 2, {'a': 1}, {'a': 2, 'b': [1]}],
+        'd': {'a': 1, 'e': {'g': 3}},
+        'ls': [{'k': 'A', 'v': 1}, {'k': 'B', 'v': '2'}, {'v': None}, 3, 'str'],
+        'e': [],
+    }
+
+    def assertSameOutcome(self, rule, data):
+        compiled = compile_rule(rule)
+        self.assertIsNotNone(compiled.native, rule)
+        expected = outcome(lambda d: compiled.execute(Tree(d)), data)
+        self.assertEqual(outcome(compiled.native, data), expected, rule)
+
+    def test_expressions(self):
+        rules = [
+            "$.a is 1", "$.a is '1'", "$.s is x", "$.b is 2", "$.a is 1.0", "$.a is not 2", "$.l is not $.l",
+            "$.a + $.b", "$.s + $.a", "$.l + $.a", "$.a - $.b", "$.s - $.a", "$.a * 3", "$.a / 2", "$.a % 2", "-$.a",
+            "not $.a", "$.a and $.s", "$.a > 0 and $.b < 3", "$.z or $.a",
+            "$.a in $.l", "$.a in $.ls.v", "$.s in 'xyz'", "$.s not in 'abc'", "$.s > 1",
+            "$.l.a", "$.l.*", "$.d.e.g", "$.d.*", "$.s.upper", "$.a.x",
+            "$.ls[@.k is A]", "$.ls[@.v > 0]", "$.ls[@.v is 2]", "$.ls[@.k in 'AB']", "$.ls[@.v is null]",
+            "$.ls[@.k is A or @.v is 2]", "$.ls[@.k is A and @.v is 1].v", "$.ls[@.v >= $.a]", "$.d[@.a is 1]",
+            "$.e[@.a is 1]", "$.missing[@.a is 1]",
+            "len($.ls)", "len($.l.a)", "len($.s)", "len($.ls[@.v > 0]) > 0",
+        ]
+        for rule in rules:
+            self.assertSameOutcome(rule, self.data)
+
+    def test_pool_rules(self):
+        get_snapshot()
+        translated = [compiled for compiled in list(compiled_rules.values()) if compiled.native is not None]
+        self.assertGreater(len(translated), 5)
+
+        for data in [get_fixture(optin=True)['data'], {}, {'brp': {}}, {'brp': {'persoon': None, 'kinderen': 1}}]:
+            for compiled in translated:
+                self.assertSameOutcome(compiled.source, data)
+
+    def test_not_translatable(self):
+        for rule in ["$..a", "@.a", "$.ls[@.l[@ is 1]]", "$.ls[@.k]", "$.ls[1]", "nonexistent(1)"]:
+            self.assertIsNone(compile_rule(rule).native, rule)
+
+    def test_clock(self):
+        moment = datetime(2031, 3, 4, 12, tzinfo=timezone.utc)
+        self.assertEqual(clock.parse_moment('2031-03-04T12:00:00Z'), moment)
+        self.assertEqual(clock.parse_moment('2031-03-04T13:00:00+01:00'), moment)
+        with at(moment):
+            self.assertLess(abs(clock.utcnow() - moment), timedelta(seconds=5))
+            self.assertEqual(clock.today(), moment.date())
+        # clock.at() stops the clock, so the rules at the end of a day do not run into the next one
+        with clock.at(moment):
+            time.sleep(0.01)
+            self.assertLess(abs(clock.utcnow() - moment), timedelta(milliseconds=1))
+            # objectpath follows it as well
+            self.assertTrue(Tree({}).execute("now() > dateTime('2031-03-04T11:00:00Z')"))
+            self.assertFalse(Tree({}).execute("now() > dateTime('2031-03-04T13:00:00Z')"))
+
+    def test_date_cutoff(self):
+        rules = [
+            "dateTime($.p.g) + timeDelta(18, 0, 0, 0, 0, 0) <= now()",
+            "len($.k[now() - timeDelta(2, 0, 0, 0, 0, 0) >= dateTime(@.g) and now() - timeDelta(18, 0, 0, 0, 0, 0) <= dateTime(@.g)]) >= 1",
+        ]
+        dates = [
+            '2012-06-14T00:00:00Z', '2012-06-15T00:00:00Z', '2012-06-16T00:00:00Z',
+            '2028-06-14T00:00:00Z', '2028-06-15T00:00:00Z', '2028-06-16T00:00:00Z',
+            '2012-06-15T13:00:00Z', '2012-06-15', None, 1,
+        ]
+        for moment in [datetime(2030, 6, 15, 9, tzinfo=timezone.utc), datetime(2030, 6, 16, 0, 0, 1, tzinfo=timezone.utc)]:
+            with at(moment):
+                for rule in rules:
+                    for date in dates:
+                        self.assertSameOutcome(rule, {'p': {'g': date}, 'k': [{'g': date}]})
+
+        tree = compile_rule(rules[0]).tree
+        translated = native.translate(tree, _execute_constant)
+        cutoff = native._with_cutoff(tree, lambda root, current: translated(root))
+        with at(datetime(2030, 6, 15, 9, tzinfo=timezone.utc)):
+            self.assertEqual(cutoff.cutoff(), '2012-06-15')
+        # it rolls over with the date
+        with at(datetime(2030, 6, 16, 0, 0, 1, tzinfo=timezone.utc)):
+            self.assertEqual(cutoff.cutoff(), '2012-06-16')
+            self.assertTrue(cutoff({'p': {'g': '2012-06-16T00:00:00Z'}}, None))
+            self.assertFalse(cutoff({'p': {'g': '2012-06-17T00:00:00Z'}}, None))
+
+        # the outcome of a rule with hours changes during the day
+        tree = compile_rule("dateTime($.p.g) + timeDelta(0, 0, 0, 12, 0, 0) <= now()").tree
+        translated = native.translate(tree, _execute_constant)
+        cutoff = native._with_cutoff(tree, lambda root, current: translated(root))
+        with at(datetime(2030, 6, 15, 9, tzinfo=timezone.utc)):
+            self.assertIsNone(cutoff.cutoff())
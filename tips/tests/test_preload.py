@@ -0,0 +1,50 @@
+import gc
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from tips import preload
+from tips.server import application
+
+
+class PreloadTest(TestCase):
+    def tearDown(self):
+        gc.unfreeze()
+        gc.enable()
+
+    def test_load(self):
+        with patch.object(preload, 'PRELOAD_FREEZE', True), patch.dict(preload.startup, clear=True):
+            self.assertIs(preload.load('tips.server'), application)
+            self.assertTrue(gc.isenabled())
+            self.assertGreater(gc.get_freeze_count(), 0)
+            self.assertEqual(preload.startup['pid'], os.getpid())
+            self.assertEqual(preload.startup['frozen_objects'], gc.get_freeze_count())
+
+            report = preload.report()
+            # loaded in this process, not in a master it was forked from
+            self.assertFalse(report['preloaded'])
+            self.assertEqual(report['pid'], os.getpid())
+            self.assertGreaterEqual(report['startup_seconds'], 0)
+
+    def test_load_without_freeze(self):
+        with patch.object(preload, 'PRELOAD_FREEZE', False), patch.dict(preload.startup, clear=True):
+            self.assertIs(preload.load('tips.wsgi'), application)
+            self.assertEqual(preload.startup['frozen_objects'], 0)
+            self.assertEqual(gc.get_freeze_count(), 0)
+
+    def test_memory(self):
+        usage = preload.memory()
+        if os.path.exists('/proc/self/smaps_rollup'):
+            self.assertEqual(set(usage), {'rss_kib', 'pss_kib', 'shared_kib', 'private_kib'})
+            self.assertGreater(usage['rss_kib'], 0)
+            self.assertEqual(usage['rss_kib'], usage['shared_kib'] + usage['private_kib'])
+        with patch('builtins.open', side_effect=FileNotFoundError):
+            self.assertEqual(preload.memory(), {})
+
+    def test_status(self):
+        with patch.dict(preload.startup, {'pid': os.getpid() + 1, 'seconds': 1.5, 'frozen_objects': 10}):
+            response = application.test_client().get('/status/memory')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['preloaded'])
+        self.assertEqual(response.json['startup_seconds'], 1.5)
+        self.assertEqual(response.json['frozen_objects'], 10)
@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+from unittest.mock import patch
+
+from tips.api import tip_generator
+from tips.api.result_cache import ResultCache, fingerprint
+from tips.api.tip_generator import tips_generator, TIPS_POOL
+from tips.generator import clock
+from tips.tests.fixtures.fixture import get_fixture
+
+
+PATHS = [
+    (('brp', 'kinderen'), [('geboortedatum',)]),
+    (('brp', 'persoon', 'mokum'), None),
+]
+SOURCES = ['brp']
+
+
+class FingerprintTest(TestCase):
+    def test_only_relevant_data(self):
+        user_data = get_fixture(optin=True)
+        key = fingerprint(user_data, PATHS, SOURCES)
+
+        user_data['data']['brp']['kinderen'][0]['voornamen'] = 'Other'
+        user_data['data']['brp']['persoon']['voornamen'] = 'Other'
+        del user_data['data']['focus']
+        self.assertEqual(fingerprint(user_data, PATHS, SOURCES), key)
+
+        user_data['data']['brp']['kinderen'][0]['geboortedatum'] = '2012-01-01T00:00:00Z'
+        self.assertNotEqual(fingerprint(user_data, PATHS, SOURCES), key)
+
+    def test_absent(self):
+        user_data = get_fixture(optin=True)
+        user_data['data']['brp']['persoon']['mokum'] = None
+        key = fingerprint(user_data, PATHS, SOURCES)
+
+        del user_data['data']['brp']['persoon']['mokum']
+        self.assertNotEqual(fingerprint(user_data, PATHS, SOURCES), key)
+
+    def test_utc_day(self):
+        midnight = datetime(2031, 3, 5, tzinfo=timezone.utc)
+        for optin in (True, False):
+            user_data = get_fixture(optin=optin)
+            with clock.at(midnight - timedelta(hours=23)):
+                morning = fingerprint(user_data, PATHS, SOURCES)
+            with clock.at(midnight - timedelta(seconds=1)):
+                before = fingerprint(user_data, PATHS, SOURCES)
+            with clock.at(midnight + timedelta(seconds=1)):
+                after = fingerprint(user_data, PATHS, SOURCES)
+            # the key changes at midnight UTC, when the rules roll over to the next day
+            self.assertEqual(before, morning)
+            self.assertNotEqual(before, after)
+
+    def test_optin(self):
+        key = fingerprint(get_fixture(optin=False), PATHS, SOURCES)
+        self.assertEqual(fingerprint({"optin": False, "data": {}}, PATHS, SOURCES), key)
+        self.assertNotEqual(fingerprint(get_fixture(optin=True), PATHS, SOURCES), key)
+
+
+class ResultCacheTest(TestCase):
+    def test_get_put(self):
+        cache = ResultCache(10000, 60)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', (1, 2))
+        self.assertEqual(cache.get('a'), (1, 2))
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_evict(self):
+        cache = ResultCache(1000, 60)
+        for i in range(10):
+            cache.put(i, ())
+        self.assertLessEqual(cache.bytes, 1000)
+        self.assertGreater(cache.stats()['evictions'], 0)
+        # least recently used are evicted first
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.get(9), ())
+
+    def test_expire(self):
+        cache = ResultCache(1000, 0)
+        cache.put('a', ())
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+
+class CachedGeneratorTest(TestCase):
+    def test_cached(self):
+        snapshot = tip_generator.get_snapshot()
+        cache = ResultCache(100000, 60)
+        user_data = get_fixture(optin=True)
+
+        with patch.object(tip_generator, '_snapshot', snapshot._replace(result_cache=cache)):
+            result = tips_generator(user_data)
+            self.assertEqual(cache.stats()['misses'], 1)
+
+            # source tips are not cached
+            user_data['data']['belasting']['tips'] = []
+            cached_result = tips_generator(user_data)
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cached_result, result)
+
+            # the result for users who did not opt in is prebuilt
+            tips_generator(get_fixture(optin=False))
+            self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+            self.assertIsNone(cache.get((TIPS_POOL, b'unknown')))
@@ -1,10 +1,13 @@
 from unittest import TestCase
+from unittest.mock import patch
 
 import objectpath
 import json
 import os
 
-from tips.generator.rule_engine import apply_rules
+from tips.generator import rule_engine
+from tips.generator.rule_engine import apply_rules, apply_rules_batch, compile_rule, compile_rules, RuleCompileError, \
+    EvaluationContext, CompoundRuleCycleError, order_rules, required_sources, prune, rule_paths, UserData
 from tips.config import PROJECT_PATH
 from tips.tests.fixtures.fixture import get_fixture
 
@@ -93,6 +96,8 @@ class RuleEngineTest(TestCase):
         rules = [{"type": "ref", "ref_id": "1"}]
         with self.assertRaises(RecursionError):
             apply_rules(self.test_data, rules, compound_rules)
+        with self.assertRaises(CompoundRuleCycleError):
+            apply_rules(self.test_data, rules, compound_rules)
 
         # self referencing
         compound_rules = {
@@ -107,6 +112,87 @@ class RuleEngineTest(TestCase):
         with self.assertRaises(RecursionError):
             apply_rules(self.test_data, rules, compound_rules)
 
+    def test_apply_rules_short_circuit(self):
+        rules = [
+            {"type": "rule", "rule": "false"},
+            {"type": "rule", "rule": "true"},
+            {"type": "rule", "rule": "$.b[@.x is true]"},
+        ]
+        context = EvaluationContext()
+        self.assertFalse(apply_rules(self.test_data, rules, {}, context))
+        self.assertEqual(context.evaluated, 1)
+        self.assertEqual(context.skipped, 2)
+
+        context = EvaluationContext()
+        self.assertTrue(apply_rules(self.test_data, rules[1:], {}, context))
+        self.assertEqual(context.evaluated, 2)
+        self.assertEqual(context.skipped, 0)
+
+    def test_apply_rules_batch(self):
+        rules = [
+            {"type": "rule", "rule": "len($.a) > 1"},
+            {"type": "rule", "rule": "$.b[@.x is true]"},
+        ]
+        userdatas = [
+            self.test_data,
+            objectpath.Tree({'a': [1]}),
+            objectpath.Tree({'a': [1, 2], 'b': [{'x': False}]}),
+            objectpath.Tree({'a': [1, 2], 'b': [{'x': True}]}),
+        ]
+        contexts = [EvaluationContext() for _ in userdatas]
+
+        self.assertEqual(apply_rules_batch(userdatas, rules, {}, contexts), [0, 3])
+        self.assertEqual([c.evaluated for c in contexts], [2, 1, 2, 2])
+        self.assertEqual([c.skipped for c in contexts], [0, 1, 0, 0])
+
+        # the same outcome as applying the rules for every user on its own
+        self.assertEqual(
+            [i for (i, userdata) in enumerate(userdatas) if apply_rules(userdata, rules, {})],
+            [0, 3]
+        )
+        self.assertEqual(apply_rules_batch([], rules, {}, []), [])
+
+    def test_apply_rules_generator(self):
+        self.assertTrue(apply_rules(self.test_data, [{"type": "rule", "rule": "$.b[@.x is false]"}], {}))
+        self.assertFalse(apply_rules(self.test_data, [{"type": "rule", "rule": "$.b[@.x is 'nope']"}], {}))
+
+    def test_order_rules(self):
+        expensive = {"type": "rule", "rule": "len($.brp.kinderen[now() - timeDelta(2, 0, 0, 0, 0, 0) >= dateTime(@.geboortedatum)]) >= 1"}
+        cheap = {"type": "rule", "rule": "$.brp.persoon.mokum is true"}
+        ref = {"type": "ref", "ref_id": "2"}
+
+        self.assertEqual(order_rules([expensive, ref, cheap], compound_rules), [cheap, ref, expensive])
+
+        # measured costs take precedence over the estimate
+        costs = {cheap['rule']: 1000}
+        self.assertEqual(order_rules([expensive, ref, cheap], compound_rules, costs), [ref, expensive, cheap])
+
+    def test_compound_rule_cached(self):
+        compound_rules = {
+            "1": {
+                "name": "rule 1",
+                "rules": [
+                    {"type": "rule", "rule": "$.a[0] is 1"}
+                ]
+            },
+            "2": {
+                "name": "rule 2",
+                "rules": [
+                    {"type": "ref", "ref_id": "1"},
+                    {"type": "rule", "rule": "false"}
+                ]
+            }
+        }
+        context = EvaluationContext()
+        self.assertTrue(apply_rules(self.test_data, [{"type": "ref", "ref_id": "1"}], compound_rules, context))
+        self.assertFalse(apply_rules(self.test_data, [{"type": "ref", "ref_id": "2"}], compound_rules, context))
+        self.assertEqual(context.compound_results, {"1": True, "2": False})
+
+        # the cached result is used, not the changed rule
+        compound_rules["1"]["rules"] = [{"type": "rule", "rule": "false"}]
+        self.assertTrue(apply_rules(self.test_data, [{"type": "ref", "ref_id": "1"}], compound_rules, context))
+        self.assertFalse(apply_rules(self.test_data, [{"type": "ref", "ref_id": "1"}], compound_rules))
+
     def test_stadspas(self):
         fixture = get_fixture()
         user_data = objectpath.Tree(fixture["data"])
@@ -378,3 +464,93 @@ class RuleEngineTest(TestCase):
         })
         ret5 = user_data.execute("len($.focus.*[@.soortProduct is 'Minimafonds' and @.typeBesluit is 'Toekenning' and now() - timeDelta(1, 0, 0, 0, 0, 0) <= dateTime(@.processtappen.beslissing.datum)]) >= 1")
         self.assertTrue(ret5)
+
+
+class RuleCompileTest(TestCase):
+    def test_compile_rule_cached(self):
+        compiled = compile_rule("$.a is 1")
+        self.assertIs(compiled, compile_rule("$.a is 1"))
+        self.assertTrue(compiled.execute(objectpath.Tree({'a': 1})))
+        self.assertFalse(compiled.execute(objectpath.Tree({'a': 2})))
+
+    def test_compile_rule_invalid(self):
+        with self.assertRaises(RuleCompileError):
+            compile_rule("len($.a[")
+
+    def test_compile_rules(self):
+        compile_rules([{"type": "rule", "rule": "true"}, {"type": "ref", "ref_id": "2"}], compound_rules)
+
+        with self.assertRaises(RuleCompileError):
+            compile_rules([{"type": "rule", "rule": "1 +"}], compound_rules)
+
+        with self.assertRaises(RuleCompileError):
+            compile_rules([{"type": "ref", "ref_id": "does-not-exist"}], compound_rules)
+
+    def test_sources(self):
+        self.assertEqual(compile_rule("$.brp.persoon.mokum is true").sources, {"brp"})
+        self.assertEqual(compile_rule("$.a is 1 and len($.b[@.x is true]) > 0").sources, {"a", "b"})
+        self.assertEqual(compile_rule("now() > dateTime('2020-01-01')").sources, set())
+        self.assertIsNone(compile_rule("$.*").sources)
+
+    def test_required_sources(self):
+        self.assertEqual(required_sources([{"type": "rule", "rule": "$.erfpacht is true"}], {}), {"erfpacht"})
+        # these can match without the source
+        self.assertEqual(required_sources([{"type": "rule", "rule": "not $.erfpacht"}], {}), set())
+        self.assertEqual(required_sources([{"type": "rule", "rule": "$.a is 1 or $.b is 1"}], {}), set())
+
+        rules = [
+            {"type": "ref", "ref_id": "1"},
+            {"type": "ref", "ref_id": "3"},
+        ]
+        self.assertEqual(required_sources(rules, compound_rules), {"focus", "brp"})
+
+    def test_paths(self):
+        self.assertEqual(compile_rule("$.brp.persoon.mokum is true").paths, {("brp", "persoon", "mokum"): None})
+        self.assertEqual(compile_rule("len($.brp.kinderen) >= 1").paths, {("brp", "kinderen"): set()})
+        self.assertEqual(
+            compile_rule("len($.brp.kinderen[dateTime(@.geboortedatum) > now()]) >= 1").paths,
+            {("brp", "kinderen"): {("geboortedatum",)}}
+        )
+        # the selected elements are used, so they matter completely
+        self.assertEqual(compile_rule("len($.a[@.b is 1].c) > 1").paths, {("a",): None})
+        self.assertEqual(compile_rule("len($.a[0]) > 1").paths, {("a",): None})
+        self.assertEqual(compile_rule("len($.focus.*[@.a is 1]) > 1").paths, {("focus",): None})
+
+    def test_rule_backends(self):
+        rules = [{"type": "rule", "rule": "len($.b[@.x is true and @.y is true]) is 1"}]
+        for backend in rule_engine.RULE_BACKENDS:
+            with patch.object(rule_engine, 'RULE_BACKEND', backend):
+                userdata = UserData({'b': [{'x': True, 'y': True}, {'x': True, 'y': False}]})
+                self.assertTrue(apply_rules(userdata, rules, {}))
+                self.assertFalse(apply_rules(UserData({'b': []}), rules, {}))
+                # the native backend does not need the objectpath tree
+                self.assertEqual(userdata._tree is None, backend == 'native')
+
+    def test_differential_backend(self):
+        compiled = compile_rule("$.a is 1 and $.b is 2")
+        with patch.object(rule_engine, 'RULE_BACKEND', 'differential'), \
+                patch.object(compiled, 'native', lambda data: False):
+            with self.assertLogs(rule_engine.logger, 'WARNING') as logs:
+                # the outcome of objectpath is used
+                self.assertTrue(compiled.matches(UserData({'a': 1, 'b': 2})))
+            self.assertIn("$.a is 1 and $.b is 2", logs.output[0])
+
+    def test_prune(self):
+        data = {
+            'a': {'b': 1, 'c': 2},
+            'd': [{'e': 1, 'f': 2}, 3],
+            'g': [{'h': 1}],
+            'i': 1,
+        }
+        paths = rule_paths([
+            {"type": "rule", "rule": "$.a.b is 1"},
+            {"type": "rule", "rule": "len($.d[@.e is 1]) > 0"},
+            {"type": "rule", "rule": "$.g.h is 1"},
+            {"type": "rule", "rule": "$.x.y is 1"},
+        ], {})
+        self.assertEqual(prune(data, paths.items()), {'a': {'b': 1}, 'd': [{'e': 1}, 3], 'g': [{'h': 1}]})
+
+        # a path which reads part of another keeps all of it
+        paths = rule_paths([{"type": "rule", "rule": "$.a.b is 1"}, {"type": "rule", "rule": "$.a is 1"}], {})
+        self.assertEqual(prune(data, paths.items()), {'a': data['a']})
+        self.assertIs(prune(data, rule_paths([{"type": "rule", "rule": "$.*"}], {}).items()), data)
@@ -0,0 +1,48 @@
+import json
+import pickle
+from unittest import TestCase
+
+from tips.api.tip_record import FRONT_END_TIP_KEYS, InvalidTip, Tip, validate_tip
+
+
+class TipRecordTest(TestCase):
+    fields = {
+        'id': 'mijn-1',
+        'title': 'Tip',
+        'priority': 10,
+        'isPersonalized': True,
+        'link': {'title': 'Meer', 'to': 'https://amsterdam.nl/'},
+        'reason': ['Omdat'],
+    }
+
+    def test_tip(self):
+        tip = Tip(self.fields)
+        self.assertIsInstance(tip, dict)
+        self.assertEqual(json.loads(json.dumps(tip)), self.fields)
+        self.assertEqual(tip, Tip(self.fields))
+        self.assertEqual(list(tip), [key for key in FRONT_END_TIP_KEYS if key in self.fields])
+        self.assertEqual(len(tip), len(self.fields))
+        self.assertEqual(tip['priority'], 10)
+        self.assertEqual(tip.get('description'), None)
+        self.assertNotIn('description', tip)
+        with self.assertRaises(KeyError):
+            tip['encoded']
+        self.assertFalse(hasattr(tip, '__dict__'))
+        self.assertEqual(json.loads(tip.encoded), self.fields)
+
+        with self.assertRaises(TypeError):
+            tip['title'] = 'changed'
+        with self.assertRaises(TypeError):
+            tip.title = 'changed'
+        with self.assertRaises(TypeError):
+            tip['link']['to'] = 'changed'
+
+        copy = pickle.loads(pickle.dumps(tip))
+        self.assertEqual(copy, tip)
+        self.assertEqual(copy.encoded, tip.encoded)
+
+    def test_validate_tip(self):
+        validate_tip(self.fields)
+        for (key, value) in [('priority', 101), ('priority', '10'), ('isPersonalized', 'yes'), ('reason', 'Omdat'), ('link', 'https://amsterdam.nl/')]:
+            with self.assertRaises(InvalidTip):
+                validate_tip({**self.fields, key: value})
@@ -1,7 +1,15 @@
+import json
+import os
+import pickle
+import tempfile
+from copy import deepcopy
 from unittest import TestCase
+from unittest.mock import patch
 
-from tips.api.tip_generator import tips_generator, fix_id, \
-    format_tip, get_tips_from_user_data
+from tips.api import tip_generator
+from tips.api.tip_generator import tips_generator, tips_generator_batch, fix_id, \
+    format_tip, get_tips_from_user_data, SourceIndex, index_enrichments, enrich_tip, sort_tips
+from tips.generator.rule_engine import apply_rules, CompoundRuleCycleError
 from tips.tests.fixtures.fixture import get_fixture
 
 _counter = 0
@@ -55,6 +63,42 @@ class TipsGeneratorTest(TestCase):
             fields = sorted(tip.keys())
             self.assertEqual(allow_list, fields)
 
+    def test_pool_not_changed(self):
+        tip1_mock = get_tip()
+        tip1_mock['rules'] = [new_rule("true")]
+        tip2_mock = get_tip()
+        tip2_mock['reason'] = ['reason']
+        tips_pool = [tip1_mock, tip2_mock]
+        original = deepcopy(tips_pool)
+
+        client_data = self.get_client_data()
+        original_client_data = deepcopy(client_data)
+
+        result = tips_generator(client_data, tips_pool)
+        self.assertEqual(len(result['items']), 3)
+        self.assertEqual(tips_pool, original)
+        self.assertEqual(client_data, original_client_data)
+
+    def test_records_frozen(self):
+        snapshot = tip_generator.get_snapshot()
+        record = snapshot.indexes[tip_generator.TIPS_POOL].entries[0].record
+
+        self.assertEqual(sorted(record.keys()), sorted(tip_generator.FRONT_END_TIP_KEYS))
+        with self.assertRaises(TypeError):
+            record['title'] = 'changed'
+        with self.assertRaises(TypeError):
+            record['link']['to'] = 'changed'
+
+    def test_encode_response(self):
+        user_data = get_fixture(optin=False)
+        result = tips_generator(user_data)
+        self.assertTrue(any(type(tip) is tip_generator.Tip for tip in result['items']))
+        self.assertTrue(any(type(tip) is not tip_generator.Tip for tip in result['items']))
+        self.assertEqual(json.loads(tip_generator.encode_response(result)), json.loads(json.dumps(result)))
+
+        record = result['items'][0]
+        self.assertEqual(pickle.loads(pickle.dumps(record)).encoded, record.encoded)
+
     def test_generator(self):
         tip0 = get_tip(10)
         tip1 = get_tip(20)
@@ -80,6 +124,72 @@ class TipsGeneratorTest(TestCase):
         # check enrichment
         self.assertEqual(tips[4]['imgUrl'], 'api/tips/static/tip_images/belastingen.jpg')
 
+    def test_batch(self):
+        optin = get_fixture(optin=True)
+        moved = get_fixture(optin=True)
+        moved['data']['brp']['adres']['begindatumVerblijf'] = '2001-01-01T00:00:00Z'
+        del moved['data']['belasting']
+        optout = get_fixture(optin=False)
+        user_datas = [optin, optout, moved, optin]
+
+        results = tips_generator_batch(user_datas)
+        self.assertEqual(results, [tips_generator(user_data) for user_data in user_datas])
+
+        income = tips_generator_batch(user_datas, pool=tip_generator.INCOME_TIPS_POOL)
+        self.assertEqual(income, [tips_generator(user_data, pool=tip_generator.INCOME_TIPS_POOL) for user_data in user_datas])
+
+        self.assertEqual(tips_generator_batch([]), [])
+
+
+class SnapshotTest(TestCase):
+    def test_income_tips_pool(self):
+        snapshot = tip_generator.get_snapshot()
+        self.assertEqual(len(snapshot.income_tips_pool), 30)
+        self.assertIs(snapshot.indexes[tip_generator.INCOME_TIPS_POOL].tips, snapshot.income_tips_pool)
+
+        tip = next(tip for tip in snapshot.income_tips_pool if tip['id'] == 'pio-15')
+        self.assertEqual(tip['reason'], ['Heeft een geldige stadspas'])
+
+    def test_cyclic_compound_rules(self):
+        compound_rules = {
+            "1": {"name": "rule 1", "reason": "Een", "rules": [{"type": "ref", "ref_id": "2"}]},
+            "2": {"name": "rule 2", "reason": "Twee", "rules": [{"type": "ref", "ref_id": "1"}]},
+        }
+        tips = [dict(get_tip(), reason="Tip", rules=[{"type": "ref", "ref_id": "1"}])]
+        with tempfile.TemporaryDirectory() as directory:
+            for name, content in [('compound_rules.json', compound_rules), ('tips.json', tips)]:
+                with open(os.path.join(directory, name), 'w') as fp:
+                    json.dump(content, fp)
+            # loading does not recurse forever, only evaluating fails
+            compound_rules = tip_generator.load_compound_rules(os.path.join(directory, 'compound_rules.json'))
+            tips = tip_generator.load_tips(os.path.join(directory, 'tips.json'), compound_rules)
+        self.assertEqual(tips[0]['reason'], ["Tip", "Een", "Twee"])
+        with self.assertRaises(CompoundRuleCycleError):
+            apply_rules({}, tips[0]['rules'], compound_rules)
+
+    def test_reload(self):
+        snapshot = tip_generator.get_snapshot()
+        new_snapshot = tip_generator.reload_snapshot()
+
+        self.assertIsNot(new_snapshot, snapshot)
+        self.assertIs(tip_generator.get_snapshot(), new_snapshot)
+        self.assertEqual(new_snapshot.mtimes, snapshot.mtimes)
+        self.assertEqual([tip['id'] for tip in new_snapshot.tips_pool], [tip['id'] for tip in snapshot.tips_pool])
+
+    def test_reload_on_change(self):
+        snapshot = tip_generator.get_snapshot()
+        changed = snapshot._replace(mtimes=())
+
+        with patch.object(tip_generator, '_snapshot', changed), patch.object(tip_generator, 'RELOAD_INTERVAL', 1), \
+                patch.object(tip_generator, '_next_check', 0):
+            # the old snapshot is served while the new one is built
+            self.assertIs(tip_generator.get_snapshot(), changed)
+            with tip_generator._reload_lock:
+                new_snapshot = tip_generator._snapshot
+
+        self.assertIsNot(new_snapshot, changed)
+        self.assertEqual(new_snapshot.mtimes, tip_generator.get_content_mtimes())
+
 
 class ConditionalTest(TestCase):
     def get_client_data(self, optin=False):
@@ -197,6 +307,82 @@ class ConditionalTest(TestCase):
         self.assertEqual(tips[0]['id'], tip1_mock['id'])
         self.assertEqual(tips[0]['isPersonalized'], True)
 
+    def test_source_index(self):
+        tip1_mock = get_tip()
+        tip1_mock['rules'] = [new_rule("$.erfpacht is true")]
+        tip2_mock = get_tip()
+        tip2_mock['rules'] = [{"type": "ref", "ref_id": "3"}]
+        tip3_mock = get_tip()
+        tip3_mock['rules'] = [new_rule("true")]
+        tip4_mock = get_tip()
+
+        index = SourceIndex([tip1_mock, tip2_mock, tip3_mock, tip4_mock], tip_generator.get_snapshot().compound_rules, {})
+        self.assertEqual([entry.tip for entry in index.without_sources], [tip3_mock, tip4_mock])
+        self.assertEqual([entry.tip for entry in index.candidates({'erfpacht'})], [tip1_mock, tip3_mock, tip4_mock])
+        self.assertEqual([entry.tip for entry in index.candidates({'erfpacht', 'brp'})], [tip1_mock, tip2_mock, tip3_mock, tip4_mock])
+
+    def test_source_index_sorted(self):
+        tips = [get_tip(priority) for priority in (10, 30, 20, 30)]
+        index = SourceIndex(tips, {}, {})
+        self.assertEqual([entry.tip for entry in index.entries], [tips[1], tips[3], tips[2], tips[0]])
+
+    def test_source_tips_merged(self):
+        tip1_mock = get_tip(priority=20)
+        tip2_mock = get_tip(priority=10)
+        user_data = self.get_client_data()
+        user_data['data'] = {'source': {'tips': [{'id': 'a', 'priority': 15}, {'id': 'b', 'priority': 20}, {'id': 'c', 'priority': 5}]}}
+
+        result = tips_generator(user_data, [tip2_mock, tip1_mock])
+        # at the same priority the pool tips come first
+        self.assertEqual([tip['id'] for tip in result['items']], [tip1_mock['id'], 'b', 'a', tip2_mock['id'], 'c'])
+        self.assertEqual(result['total'], 5)
+
+    def test_optout_matches(self):
+        tip1_mock = get_tip(priority=10)
+        tip1_mock['rules'] = [new_rule("true")]
+        tip2_mock = get_tip(priority=20)
+        tip2_mock['rules'] = [new_rule("false")]
+        tip3_mock = get_tip(priority=30)
+        tip4_mock = get_tip()
+        tip4_mock['rules'] = [new_rule("$.erfpacht is true")]
+
+        index = SourceIndex([tip1_mock, tip2_mock, tip3_mock, tip4_mock], {}, {})
+        # sorted by priority
+        self.assertEqual([record['id'] for record in index.optout_matches()], [tip3_mock['id'], tip1_mock['id']])
+
+        # the rules of the pool ran when the snapshot was built
+        user_data = get_fixture(optin=False)
+        expected = tips_generator(user_data)
+        with patch.object(tip_generator, 'tip_filter') as tip_filter:
+            self.assertEqual(tips_generator(user_data), expected)
+            del user_data['data']['belasting']
+            # without tips in the user data it is the response which was encoded when the snapshot was built
+            response = tips_generator(user_data)
+            self.assertIs(response, tip_generator.get_snapshot().indexes['tips'].optout_response())
+            self.assertEqual(response['items'], tip_generator.get_snapshot().indexes['tips'].optout_matches())
+            self.assertIs(tip_generator.encode_response(response), response.encoded)
+            self.assertEqual(json.loads(response.encoded), json.loads(json.dumps(response)))
+            tip_filter.assert_not_called()
+
+    def test_merge_tips(self):
+        tips = [get_tip(priority) for priority in (5, 30, 10, 20, 10)]
+        pool = sort_tips([get_tip(priority) for priority in (10, 40, 20, 0)])
+        self.assertEqual(tip_generator.merge_tips(pool, list(tips)), sort_tips(pool + tips))
+        self.assertEqual(tip_generator.merge_tips([], list(tips)), sort_tips(list(tips)))
+        self.assertEqual(tip_generator.merge_tips(pool, []), pool)
+
+    def test_missing_source(self):
+        tip1_mock = get_tip()
+        tip1_mock['rules'] = [new_rule("$.erfpacht is true")]
+        tip1_mock['isPersonalized'] = True
+        tips_pool = [tip1_mock]
+
+        client_data = self.get_client_data(optin=True)
+        del client_data['data']['erfpacht']
+
+        result = tips_generator(client_data, tips_pool)
+        self.assertEqual(result['items'], [])
+
     def test_is_personalized(self):
         tip1_mock = get_tip()
         tip1_mock['rules'] = [new_rule("True")]
@@ -215,6 +401,29 @@ class ConditionalTest(TestCase):
         self.assertEqual(tips[1]['isPersonalized'], False)
 
 
+class EnrichmentTest(TestCase):
+    def test_index_enrichments(self):
+        enrichments = [
+            {"id": "1", "for_ids": ["a", "b"], "fields": {"imgUrl": "1.jpg"}},
+            {"id": "2", "for_ids": ["b", "c"], "fields": {"imgUrl": "2.jpg"}},
+        ]
+        index = index_enrichments(enrichments)
+        self.assertEqual(index, {"a": enrichments[0], "b": enrichments[0], "c": enrichments[1]})
+
+        tip = {"id": "b", "imgUrl": "0.jpg"}
+        self.assertEqual(enrich_tip(tip, index), {"id": "b", "imgUrl": "1.jpg"})
+        self.assertEqual(tip["imgUrl"], "0.jpg")
+
+        tip = {"id": "d", "imgUrl": "0.jpg"}
+        self.assertIs(enrich_tip(tip, index), tip)
+
+    def test_pool_enriched(self):
+        tip = get_tip()
+        index = SourceIndex([tip], {}, index_enrichments([{"for_ids": [tip['id']], "fields": {"imgUrl": "1.jpg"}}]))
+        self.assertEqual(index.entries[0].record['imgUrl'], "1.jpg")
+        self.assertEqual(tip['imgUrl'], '/api/tips/static/tip_images/erfpacht.jpg')
+
+
 class SourceTipsTests(TestCase):
     def setUp(self) -> None:
         pass
@@ -287,12 +496,11 @@ class SourceTipsTests(TestCase):
             'id': 1,
             'title': 'foo',
         }
-        fix_id(belasting_tip, 'belasting')
-        self.assertEqual(belasting_tip['id'], 'belasting-1')
+        self.assertEqual(fix_id(belasting_tip, 'belasting'), 'belasting-1')
+        self.assertEqual(belasting_tip['id'], 1)
 
         other_tip = {
             'id': '1',
             'title': 'bar',
         }
-        fix_id(other_tip, 'something else')
-        self.assertEqual(other_tip['id'], '1')
+        self.assertEqual(fix_id(other_tip, 'something else'), '1')
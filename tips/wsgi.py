@@ -0,0 +1,8 @@
+"""
+WSGI entry point for uWSGI, which preloads the application in the master process (see tips.preload):
+
+    UWSGI_MODULE=tips.wsgi:application uwsgi --ini uwsgi.ini
+"""
+from tips.preload import load
+
+application = load('tips.server')